@@ -1,125 +1,167 @@
 # -*- coding: utf-8 -*-
 import socket
 import time
-import re
+import select
+import random
+import selectors
 import os
 import json
-import subprocess
 import collections
 import platform
+import threading
 
 SERVER = "mm.auto987.com"
 PORT = 35601
 USER = ""
 PASSWORD = "doub.io"
 INTERVAL = 1  # 更新间隔，单位：秒
+# 本地磁盘文件系统, zfs 在 /proc/filesystems 中标记为 nodev, 不能按 nodev 过滤
+VALID_FS = set(["ext4", "ext3", "ext2", "reiserfs", "jfs", "btrfs",
+                "fuseblk", "zfs", "simfs", "ntfs", "fat32", "exfat", "xfs"])
 
 
-def get_uptime():
-    with open('/proc/uptime', 'r') as f:
-        uptime = f.readline().split()[0]
-    return int(float(uptime))
+class ProcFile:
+    """/proc file kept open, re-read from offset 0 with os.pread"""
 
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
 
-def get_memory():
-    re_parser = re.compile(r'^(?P<key>\S*):\s*(?P<value>\d*)\s*kB')
-    result = {}
-    with open('/proc/meminfo') as f:
-        for line in f:
-            match = re_parser.match(line)
-            if not match:
-                continue
-            key, value = match.groups()
-            result[key] = int(value)
-
-    MemTotal = result.get('MemTotal', 0)
-    MemFree = result.get('MemFree', 0)
-    Cached = result.get('Cached', 0)
-    MemUsed = MemTotal - (MemFree + Cached)
-    SwapTotal = result.get('SwapTotal', 0)
-    SwapFree = result.get('SwapFree', 0)
-    return MemTotal, MemUsed, SwapTotal, SwapFree
-
-
-def get_hdd():
-    try:
-        output = subprocess.check_output(
-            ['df', '-Tlm', '--total'], stderr=subprocess.DEVNULL
-        ).decode("utf-8")
-        total = output.splitlines()[-1]
-        size, used = total.split()[2], total.split()[3]
-        return int(size), int(used)
-    except Exception:
-        return 0, 0
-
-
-def get_load():
-    try:
-        output = os.popen("ss -ant | grep ESTAB | wc -l").read()
-        return float(output.strip())
-    except Exception:
-        return 0.0
+    def read(self):
+        chunks, off = [], 0
+        while True:
+            b = os.pread(self.fd, 65536, off)
+            if not b:
+                break
+            chunks.append(b)
+            off += len(b)
+        return b"".join(chunks)
 
 
-def get_time():
-    with open("/proc/stat", "r") as f:
-        time_list = f.readline().split()[1:5]
-    return [int(x) for x in time_list]
+class Mounts:
+    """local block device mounts, re-read only when the mount table changes"""
 
+    def __init__(self):
+        self.mounts = None
+        self.poll = None
+        try:
+            self.mountinfo = open("/proc/self/mountinfo", "rb")
+            self.poll = select.poll()
+            # kernel raises POLLPRI|POLLERR on the open file when the mount table changes
+            self.poll.register(self.mountinfo, select.POLLPRI | select.POLLERR)
+        except (OSError, AttributeError):
+            self.poll = None
 
-def delta_time():
-    x = get_time()
-    time.sleep(INTERVAL)
-    y = get_time()
-    return [y[i] - x[i] for i in range(len(x))]
+    def _load(self):
+        mounts = {}
+        with open("/proc/self/mounts", "r") as f:
+            for line in f:
+                device, path, fstype = line.split()[:3]
+                if fstype not in VALID_FS:
+                    continue
+                # datasets of one zfs pool share its space, count the pool once
+                if fstype == "zfs":
+                    device = device.split("/", 1)[0]
+                if device in mounts:
+                    continue
+                mounts[device] = path.replace("\\040", " ")
+        return list(mounts.values())
 
+    def usage(self):
+        if self.mounts is None or self.poll is None or self.poll.poll(0):
+            self.mounts = self._load()
+        size, used = 0, 0
+        for path in self.mounts:
+            try:
+                st = os.statvfs(path)
+            except OSError:
+                continue
+            size += st.f_blocks * st.f_frsize
+            used += (st.f_blocks - st.f_bfree) * st.f_frsize
+        return size // 1024 // 1024, used // 1024 // 1024
 
-def get_cpu():
-    t = delta_time()
-    total = sum(t)
-    idle = t[-1]
-    if total == 0:
-        return 0
-    return round((1 - idle / total) * 100, 2)
 
+class Snapshot:
+    """reads every /proc file once per tick, all fields are served from it"""
 
-class Traffic:
     def __init__(self):
+        self.files = {
+            "uptime": ProcFile("/proc/uptime"),
+            "meminfo": ProcFile("/proc/meminfo"),
+            "stat": ProcFile("/proc/stat"),
+            "net_dev": ProcFile("/proc/net/dev"),
+            "tcp": ProcFile("/proc/net/tcp"),
+        }
+        if os.path.exists("/proc/net/tcp6"):
+            self.files["tcp6"] = ProcFile("/proc/net/tcp6")
+        self.mounts = Mounts()
         self.rx = collections.deque(maxlen=10)
         self.tx = collections.deque(maxlen=10)
+        self.cpu_times = None
 
-    def get(self):
-        with open('/proc/net/dev', 'r') as f:
-            net_dev = f.readlines()
+    def refresh(self):
+        f = self.files
+        stats = {}
 
-        avgrx, avgtx = 0, 0
-        for dev in net_dev[2:]:
-            dev = dev.split(':')
-            if dev[0].strip() == "lo" or "tun" in dev[0]:
-                continue
-            data = dev[1].split()
-            avgrx += int(data[0])
-            avgtx += int(data[8])
+        stats["uptime"] = int(float(f["uptime"].read().split(None, 1)[0]))
 
-        self.rx.append(avgrx)
-        self.tx.append(avgtx)
+        mem = {}
+        for line in f["meminfo"].read().split(b"\n"):
+            key, _, rest = line.partition(b":")
+            if rest:
+                mem[key] = int(rest.split()[0])
+        MemTotal = mem.get(b"MemTotal", 0)
+        SwapTotal = mem.get(b"SwapTotal", 0)
+        stats["memory_total"] = MemTotal
+        stats["memory_used"] = MemTotal - (mem.get(b"MemFree", 0) + mem.get(b"Cached", 0))
+        stats["swap_total"] = SwapTotal
+        stats["swap_used"] = SwapTotal - mem.get(b"SwapFree", 0)
 
-        if len(self.rx) > 1:
-            avgrx = int((self.rx[-1] - self.rx[0]) / len(self.rx) / INTERVAL)
-            avgtx = int((self.tx[-1] - self.tx[0]) / len(self.tx) / INTERVAL)
+        # cpu: user nice system idle, delta against the previous tick
+        cur = [int(x) for x in f["stat"].read().split(b"\n", 1)[0].split()[1:5]]
+        stats["cpu"] = 0
+        if self.cpu_times is not None:
+            t = [cur[i] - self.cpu_times[i] for i in range(4)]
+            total = sum(t)
+            if total > 0:
+                stats["cpu"] = round((1 - t[-1] / total) * 100, 2)
+        self.cpu_times = cur
 
-        return avgrx, avgtx
+        rate_rx, rate_tx, total_in, total_out = 0, 0, 0, 0
+        for line in f["net_dev"].read().split(b"\n")[2:]:
+            name, _, data = line.partition(b":")
+            if not data:
+                continue
+            name = name.strip()
+            data = data.split()
+            rx, tx = int(data[0]), int(data[8])
+            if name == b"lo":
+                continue
+            total_in += rx
+            total_out += tx
+            if b"tun" not in name:
+                rate_rx += rx
+                rate_tx += tx
+        self.rx.append(rate_rx)
+        self.tx.append(rate_tx)
+        if len(self.rx) > 1:
+            rate_rx = int((self.rx[-1] - self.rx[0]) / len(self.rx) / INTERVAL)
+            rate_tx = int((self.tx[-1] - self.tx[0]) / len(self.tx) / INTERVAL)
+        stats["network_rx"] = rate_rx
+        stats["network_tx"] = rate_tx
+        stats["network_in"] = total_in
+        stats["network_out"] = total_out
 
+        # established tcp connections, same as `ss -ant | grep ESTAB | wc -l`
+        estab = 0
+        for name in ("tcp", "tcp6"):
+            if name in f:
+                for line in f[name].read().split(b"\n")[1:]:
+                    if line and line.split(None, 4)[3] == b"01":
+                        estab += 1
+        stats["load"] = float(estab)
 
-def liuliang():
-    NET_IN, NET_OUT = 0, 0
-    with open('/proc/net/dev', 'r') as f:
-        for line in f:
-            netinfo = re.findall(r'([^\s]+):[\s]*(\d+)', line)
-            if netinfo and netinfo[0][0] != "lo":
-                NET_IN += int(netinfo[0][1])
-                NET_OUT += int(netinfo[-1][1])
-    return NET_IN, NET_OUT
+        stats["hdd_total"], stats["hdd_used"] = self.mounts.usage()
+        return stats
 
 
 def get_network(ip_version):
@@ -131,42 +173,188 @@ def get_network(ip_version):
         return False
 
 
+def backoff_delay(failures):
+    """exponential, capped at 60s, half fixed, half random, so clients do not come back in the same second"""
+    delay = min(60.0, 2.0 ** failures)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class Session:
+    """non-blocking session for the line protocol, sampling never waits on it
+
+    reports go through a bounded queue (oldest dropped when full), the socket
+    is driven by a selector loop, reconnects back off exponentially with jitter
+    """
+
+    def __init__(self, server, port, user, password, max_queue=10):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sel = selectors.DefaultSelector()
+        self.queue = collections.deque(maxlen=max_queue)
+        self.sock = None
+        self.state = None
+        self.auth_sent = False
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.failures = 0
+        self.retry_ts = 0.0
+        self.deadline = 0.0
+        # last good getaddrinfo entry, and the lookup in progress
+        self.addr = None
+        self.resolving = None
+
+    def send(self, line):
+        self.queue.append(line)
+
+    def _resolve(self):
+        """getaddrinfo on its own thread, a slow resolver must not stall sampling"""
+        done, result = threading.Event(), {}
+
+        def run():
+            try:
+                result["addr"] = socket.getaddrinfo(
+                    self.server, self.port, 0, socket.SOCK_STREAM)[0]
+            except OSError as e:
+                result["err"] = e
+            done.set()
+
+        threading.Thread(target=run, daemon=True).start()
+        return done, result
+
+    def _connect(self, addrinfo):
+        print("Connecting...")
+        family, type_, proto, _, addr = addrinfo
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt, v in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), v)
+        self.sock = sock
+        self.state = "connecting"
+        self.auth_sent = False
+        self.inbuf.clear()
+        self.outbuf.clear()
+        self.deadline = time.monotonic() + 10
+        self.sel.register(sock, selectors.EVENT_WRITE)
+        sock.connect_ex(addr)
+
+    def _close(self, err):
+        print(f"Error: {err}")
+        if self.sock is not None:
+            self.sel.unregister(self.sock)
+            self.sock.close()
+        self.sock = None
+        self.state = None
+        self.retry_ts = time.monotonic() + backoff_delay(self.failures)
+        self.failures += 1
+
+    def _on_write(self):
+        if self.state == "connecting":
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, os.strerror(err))
+            self.state = "auth"
+            return
+        n = self.sock.send(self.outbuf)
+        del self.outbuf[:n]
+
+    def _on_read(self):
+        data = self.sock.recv(4096)
+        if not data:
+            raise ConnectionError("closed by server")
+        if self.state != "auth":
+            return
+        self.inbuf += data
+        if not self.auth_sent:
+            if b"Authentication required" not in self.inbuf:
+                self.state = "ready"
+                self.failures = 0
+                return
+            self.auth_sent = True
+            self.inbuf.clear()
+            self.outbuf += f"{self.user}:{self.password}\n".encode('utf-8')
+        elif b"Authentication successful" in self.inbuf:
+            self.state = "ready"
+            self.failures = 0
+            print("Authentication successful")
+        elif b"\n" in self.inbuf:
+            raise ConnectionError("Authentication failed")
+
+    def run_until(self, until):
+        """drive socket io until the monotonic deadline"""
+        while True:
+            now = time.monotonic()
+            if now >= until:
+                return
+            if self.sock is None:
+                if now < self.retry_ts:
+                    time.sleep(min(until, self.retry_ts) - now)
+                    continue
+                if self.resolving is None:
+                    self.resolving = self._resolve()
+                done, result = self.resolving
+                if not done.wait(until - now):
+                    continue
+                self.resolving = None
+                if "addr" in result:
+                    self.addr = result["addr"]
+                elif self.addr is None:
+                    self._close(result["err"])
+                    continue
+                else:
+                    print(f"Resolve failed: {result['err']}, using the last address")
+                try:
+                    self._connect(self.addr)
+                except OSError as e:
+                    self._close(e)
+                continue
+
+            if self.state == "ready" and not self.outbuf:
+                while self.queue:
+                    self.outbuf += self.queue.popleft()
+            events = selectors.EVENT_READ
+            if self.state == "connecting":
+                events = selectors.EVENT_WRITE
+            elif self.outbuf:
+                events |= selectors.EVENT_WRITE
+            self.sel.modify(self.sock, events)
+
+            timeout = until - now
+            if self.state != "ready":
+                timeout = min(timeout, self.deadline - now)
+            try:
+                for key, mask in self.sel.select(max(0.0, timeout)):
+                    if mask & selectors.EVENT_WRITE:
+                        self._on_write()
+                    if mask & selectors.EVENT_READ:
+                        self._on_read()
+                if self.state != "ready" and time.monotonic() >= self.deadline:
+                    raise TimeoutError("connect/auth timeout")
+            except OSError as e:
+                self._close(e)
+
+
 if __name__ == '__main__':
-    socket.setdefaulttimeout(30)
+    session = Session(SERVER, PORT, USER, PASSWORD)
+    snapshot = Snapshot()
+    snapshot.refresh()
+    next_ts = time.monotonic()
+    errors = 0
     while True:
         try:
-            print("Connecting...")
-            with socket.create_connection((SERVER, PORT), timeout=5) as s:
-                data = s.recv(1024).decode('utf-8', errors='ignore')
-                if "Authentication required" in data:
-                    s.send(f"{USER}:{PASSWORD}\n".encode('utf-8'))
-                    data = s.recv(1024).decode('utf-8', errors='ignore')
-                    if "Authentication successful" not in data:
-                        raise ConnectionError("Authentication failed")
-
-                traffic = Traffic()
-                traffic.get()
-                while True:
-                    stats = {
-                        "cpu": get_cpu(),
-                        "network_rx": traffic.get()[0],
-                        "network_tx": traffic.get()[1],
-                        "uptime": get_uptime(),
-                        "load": get_load(),
-                        "memory_total": get_memory()[0],
-                        "memory_used": get_memory()[1],
-                        "swap_total": get_memory()[2],
-                        "swap_used": get_memory()[2] - get_memory()[3],
-                        "hdd_total": get_hdd()[0],
-                        "hdd_used": get_hdd()[1],
-                        "network_in": liuliang()[0],
-                        "network_out": liuliang()[1],
-                    }
-                    s.send(f"update {json.dumps(stats)}\n".encode('utf-8'))
-                    time.sleep(INTERVAL)
-
+            next_ts = max(next_ts + INTERVAL, time.monotonic())
+            session.run_until(next_ts)
+            stats = snapshot.refresh()
+            session.send(f"update {json.dumps(stats)}\n".encode('utf-8'))
+            errors = 0
         except KeyboardInterrupt:
             break
         except Exception as e:
             print(f"Error: {e}")
-            time.sleep(3)
+            # next tick after the backoff delay, run_until keeps the session going meanwhile
+            next_ts = time.monotonic() + backoff_delay(errors) - INTERVAL
+            errors += 1
@@ -9,22 +9,20 @@
 
 import os
 import sys
-import copy
 import json
 import time
 import shlex
-import errno
-import timeit
+import struct
+import random
+import select
 import socket
 import psutil
 import hashlib
 import threading
 import subprocess
-import requests
 import traceback
-from queue import Queue
+from array import array
 from datetime import datetime
-from requests.auth import HTTPBasicAuth
 from optparse import OptionParser
 
 CU = "cu.tz.cloudcpp.com:80"
@@ -35,9 +33,11 @@ IFACE_IGNORE_LIST = ["lo", "tun", "docker",
 
 PROBE_PROTOCOL_PREFER = 'ipv4'
 PING_PACKET_HISTORY_LEN = 100
+PROBE_RESOLVE_TTL = 300
+PROBE_RESOLVE_RETRY = 5
 INTERVAL = 1
-G_IP_INFO = None
 G_SYS_INFO = None
+G_CPU_TIMES = None
 
 
 def get_uptime():
@@ -52,39 +52,161 @@ def get_memory():
     return int(vm.total / 1024.0), int(vm.used / 1024.0), int(sm.total / 1024.0), int(sm.used / 1024.0)
 
 
-def get_hdd():
-    valid_fs = set(["ext4", "ext3", "ext2", "reiserfs", "jfs", "btrfs",
-                   "fuseblk", "zfs", "simfs", "ntfs", "fat32", "exfat", "xfs"])
-    disks, size, used = dict(), 0, 0
+VALID_FS = set(["ext4", "ext3", "ext2", "reiserfs", "jfs", "btrfs",
+                "fuseblk", "zfs", "simfs", "ntfs", "fat32", "exfat", "xfs"])
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+MOUNTS_REFRESH_INTERVAL = 60
+G_HDD = {
+    'mounts': None,
+    'mounts_ts': 0.0,
+}
+G_MOUNTS_POLL = None
+
+
+def _mounts_changed():
+    """True/False if mount table changed, None if it can not be watched"""
+    global G_MOUNTS_POLL
+    if G_MOUNTS_POLL is None:
+        if not hasattr(select, "poll") or not os.path.exists(MOUNTINFO_PATH):
+            return None
+        # kernel raises POLLPRI|POLLERR on the open file when the mount table changes
+        f = open(MOUNTINFO_PATH, "rb")
+        poller = select.poll()
+        poller.register(f, select.POLLPRI | select.POLLERR)
+        G_MOUNTS_POLL = (f, poller)
+        return True
+    return len(G_MOUNTS_POLL[1].poll(0)) > 0
+
+
+def _enum_mounts():
+    mounts = dict()
     for disk in psutil.disk_partitions():
-        if disk.device not in disks and disk.fstype.lower() in valid_fs:
-            disks[disk.device] = disk.mountpoint
-    for disk in disks.values():
-        usage = psutil.disk_usage(disk)
+        fstype = disk.fstype.lower()
+        if fstype not in VALID_FS:
+            continue
+        device = disk.device
+        # datasets of one zfs pool share its space, count the pool once
+        if fstype == "zfs":
+            device = device.split("/", 1)[0]
+        if device not in mounts:
+            mounts[device] = (disk.mountpoint, disk.fstype)
+    return mounts
+
+
+def get_hdd():
+    now = time.monotonic()
+    changed = _mounts_changed()
+    if changed or G_HDD['mounts'] is None or \
+            (changed is None and now - G_HDD['mounts_ts'] > MOUNTS_REFRESH_INTERVAL):
+        G_HDD['mounts'] = _enum_mounts()
+        G_HDD['mounts_ts'] = now
+
+    size, used, disks = 0, 0, []
+    for device, (mountpoint, fstype) in G_HDD['mounts'].items():
+        try:
+            usage = psutil.disk_usage(mountpoint)
+        except OSError:
+            continue
         size += usage.total
         used += usage.used
-    return int(size / 1024.0 / 1024.0), int(used / 1024.0 / 1024.0)
+        disks.append({
+            "name": device,
+            "mount_point": mountpoint,
+            "file_system": fstype,
+            "total": usage.total,
+            "used": usage.used,
+            "free": usage.free,
+        })
+    return int(size / 1024.0 / 1024.0), int(used / 1024.0 / 1024.0), disks
+
+
+G_CGROUP = None
+
+
+def get_cgroup_cpu(ncpu):
+    """--cgroup, cpu usage relative to the container quota, re-read every tick"""
+    return int(G_CGROUP.cpu_percent(G_CGROUP.cpu_cores(ncpu)))
+
+
+def _cpu_busy_total(t):
+    total = sum(t)
+    # guest time is already accounted in user/nice on linux
+    total -= getattr(t, "guest", 0) + getattr(t, "guest_nice", 0)
+    busy = total - t.idle - getattr(t, "iowait", 0)
+    return busy, total
 
 
-def get_cpu(options):
-    # blocking
-    # return psutil.cpu_percent(interval=INTERVAL)
-    return psutil.cpu_percent(interval=int(options.interval))
+def get_cpu():
+    """cpu usage since the previous call, by delta of cumulative cpu times"""
+    global G_CPU_TIMES
+    pre, G_CPU_TIMES = G_CPU_TIMES, _cpu_busy_total(psutil.cpu_times())
+    if pre is None or G_CPU_TIMES[1] <= pre[1]:
+        return 0
+    return int(max(0.0, min(100.0, (G_CPU_TIMES[0] - pre[0]) / (G_CPU_TIMES[1] - pre[1]) * 100)))
 
 
 def get_sys_traffic(options):
-    net_in, net_out = 0, 0
-    net = psutil.net_io_counters(pernic=True)
-    for k, v in net.items():
-        if skip_iface(k, options):
+    """in/out bytes of the selected ifaces, wrap/reset safe"""
+    if G_IFACES.ts == 0:
+        G_IFACES.update(options)
+    return G_IFACES.totals()
+
+
+VNSTAT_DB_PATH = "/var/lib/vnstat/vnstat.db"
+G_VNSTAT = {
+    'conn': None,
+    'key': None,
+    'value': None,
+}
+
+
+def _vnstat_db_traffic(options):
+    """read vnstat 2.x sqlite db, only re-query when vnstat saved new data"""
+    path = options.vnstat_db
+    mtime = os.stat(path).st_mtime
+    if os.path.exists(path + "-wal"):
+        mtime = max(mtime, os.stat(path + "-wal").st_mtime)
+    month = datetime.now().strftime("%Y-%m-01")
+    key = (mtime, month)
+    if G_VNSTAT['key'] == key:
+        return G_VNSTAT['value']
+
+    if G_VNSTAT['conn'] is None:
+        import sqlite3
+        G_VNSTAT['conn'] = sqlite3.connect(
+            "file:{}?mode=ro".format(path), uri=True, check_same_thread=False)
+    # month has a unique (interface, date) index
+    rows = G_VNSTAT['conn'].execute(
+        "SELECT i.name, i.rxtotal, i.txtotal, m.rx, m.tx FROM interface i "
+        "LEFT JOIN month m ON m.interface = i.id AND m.date = ?", (month,)).fetchall()
+
+    network_in, network_out, m_network_in, m_network_out = (0, 0, 0, 0)
+    for name, rx_total, tx_total, rx, tx in rows:
+        if skip_iface(name, options):
             continue
-        else:
-            net_in += v[1]
-            net_out += v[0]
-    return net_in, net_out
+        network_in += rx_total
+        network_out += tx_total
+        m_network_in += rx or 0
+        m_network_out += tx or 0
+
+    G_VNSTAT['key'] = key
+    G_VNSTAT['value'] = (network_in, network_out, m_network_in, m_network_out)
+    return G_VNSTAT['value']
 
 
 def get_vnstat_traffic(options):
+    if os.path.exists(options.vnstat_db):
+        try:
+            return _vnstat_db_traffic(options)
+        except Exception as ex:
+            traceback.print_exc()
+            if G_VNSTAT['conn'] is not None:
+                G_VNSTAT['conn'].close()
+            G_VNSTAT['conn'], G_VNSTAT['key'] = None, None
+    return _vnstat_json_traffic(options)
+
+
+def _vnstat_json_traffic(options):
     now = datetime.now()
     vnstat_res = subprocess.check_output(
         "/usr/bin/vnstat --json m", shell=True)
@@ -117,10 +239,42 @@ def get_vnstat_traffic(options):
     return (network_in, network_out, m_network_in, m_network_out)
 
 
+PROC_NET_TCP = ("/proc/net/tcp", "/proc/net/tcp6")
+PROC_NET_UDP = ("/proc/net/udp", "/proc/net/udp6")
+
+
+def _count_proc_net(paths):
+    """count socket entries by streaming lines, without building objects"""
+    n = 0
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                n -= 1  # header
+                for chunk in iter(lambda: f.read(65536), b""):
+                    n += chunk.count(b"\n")
+        except OSError:
+            continue
+    return max(n, 0)
+
+
+def _tupd_linux():
+    t = _count_proc_net(PROC_NET_TCP)
+    u = _count_proc_net(PROC_NET_UDP)
+    p = sum(1 for e in os.scandir("/proc") if e.name.isdigit())
+    # running/total scheduling entities, total == threads on the system
+    with open("/proc/loadavg", "r") as f:
+        d = int(f.read().split()[3].split("/")[1])
+    return t, u, p, d
+
+
 def tupd():
     """tcp/udp/process/thread count"""
     t, u, p, d = 0, 0, 0, 0
-    tcp_set, udp_set = set(), set()
+    if sys.platform.startswith("linux"):
+        try:
+            return _tupd_linux()
+        except Exception as ex:
+            traceback.print_exc()
     try:
         t = len(psutil.net_connections("tcp"))
         u = len(psutil.net_connections("udp"))
@@ -158,114 +312,380 @@ G_PING_TIME = {
     '189': 0,
     '10086': 0
 }
-G_NET_SPEED = {
-    'netrx': 0.0,
-    'nettx': 0.0,
-    'clock': 0.0,
-    'diff': 0.0,
-    'avgrx': 0,
-    'avgtx': 0
-}
+U32 = 1 << 32
 
 
-def _ping_thread(target, mark):
-    packet_lost = 0
-    packet_queue = Queue(maxsize=PING_PACKET_HISTORY_LEN)
+def counter_delta(pre, cur):
+    """delta of a monotonic counter, 32-bit wrap and reset aware"""
+    if cur >= pre:
+        return cur - pre
+    if pre < U32 and pre - cur > U32 // 2:
+        return cur + U32 - pre
+    # iface re-created or driver reloaded, the counter restarted from zero
+    return cur
 
-    host, port = target.split(":")
 
-    ip = host
-    if host.count(':') < 1:     # if not plain ipv6 address, means ipv4 address or hostname
-        try:
-            if PROBE_PROTOCOL_PREFER == 'ipv4':
-                ip = socket.getaddrinfo(host, None, socket.AF_INET)[0][4][0]
-            else:
-                ip = socket.getaddrinfo(host, None, socket.AF_INET6)[0][4][0]
-        except Exception as ex:
-            traceback.print_exc()
+class IfaceCounters:
+    """per iface rx/tx rates and totals, totals never go back on counter resets"""
+
+    # forget ifaces not seen for a day, veth/tap churn
+    STALE = 86400
+
+    def __init__(self):
+        # name => [raw rx, raw tx, total rx, total tx, rate rx, rate tx, last seen]
+        self.ifaces = {}
+        self.ts = 0.0
+        # totals of the forgotten ifaces, kept so the sums do not go back
+        self.retired = [0, 0]
 
+    def update(self, options):
+        now = time.monotonic()
+        dt = now - self.ts if self.ts > 0 else 0
+        self.ts = now
+        for name, stats in psutil.net_io_counters(pernic=True).items():
+            if skip_iface(name, options):
+                continue
+            rx, tx = stats.bytes_recv, stats.bytes_sent
+            o = self.ifaces.get(name)
+            if o is None:
+                self.ifaces[name] = [rx, tx, rx, tx, 0, 0, now]
+                continue
+            drx, dtx = counter_delta(o[0], rx), counter_delta(o[1], tx)
+            o[0], o[1] = rx, tx
+            o[2] += drx
+            o[3] += dtx
+            o[4], o[5] = (int(drx / dt), int(dtx / dt)) if dt > 0 else (0, 0)
+            o[6] = now
+        for name in [k for k, o in self.ifaces.items() if now - o[6] > self.STALE]:
+            o = self.ifaces.pop(name)
+            self.retired[0] += o[2]
+            self.retired[1] += o[3]
+
+    def rates(self):
+        return (sum(o[4] for o in self.ifaces.values() if o[6] == self.ts),
+                sum(o[5] for o in self.ifaces.values() if o[6] == self.ts))
+
+    def totals(self):
+        return (self.retired[0] + sum(o[2] for o in self.ifaces.values()),
+                self.retired[1] + sum(o[3] for o in self.ifaces.values()))
+
+    def nics(self):
+        """per iface list for custom, ifaces present at the last update"""
+        return [{"name": name, "rx": o[4], "tx": o[5], "in": o[2], "out": o[3]}
+                for name, o in sorted(self.ifaces.items()) if o[6] == self.ts]
+
+
+G_IFACES = IfaceCounters()
+
+
+G_PROBES = {}
+
+
+class ProbeWindow:
+    """sliding window over the last N probes, O(1) update"""
+
+    def __init__(self, size=PING_PACKET_HISTORY_LEN):
+        self.size = size
+        self.ok = array("b", bytes(size))
+        self.rtt = array("d", bytes(8 * size))
+        # |rtt - previous ok rtt| recorded when the slot was written
+        self.jit = array("d", bytes(8 * size))
+        self.jit_ok = array("b", bytes(size))
+        self.pos = 0
+        self.count = 0
+        self.lost = 0
+        self.last_rtt = None
+
+    def push(self, ok, rtt=0.0):
+        i = self.pos
+        if self.count == self.size:
+            if not self.ok[i]:
+                self.lost -= 1
+        else:
+            self.count += 1
+
+        self.ok[i] = 1 if ok else 0
+        self.jit_ok[i] = 0
+        if ok:
+            self.rtt[i] = rtt
+            if self.last_rtt is not None:
+                self.jit[i] = abs(rtt - self.last_rtt)
+                self.jit_ok[i] = 1
+            self.last_rtt = rtt
+        else:
+            self.lost += 1
+        self.pos = (i + 1) % self.size
+
+    def lost_rate(self):
+        return float(self.lost) / self.count if self.count else 0.0
+
+    def stats(self):
+        """loss rate, rtt min/avg/max/stddev/jitter and p50/p95/p99 in ms
+
+        called from the report thread while the probe keeps pushing, every
+        value comes from one copy of the slots, not from the running sums
+        """
+        count = self.count
+        ok, rtt = self.ok[:count], self.rtt[:count]
+        jit_ok, jit = self.jit_ok[:count], self.jit[:count]
+        jit = [jit[i] for i in range(count) if jit_ok[i]]
+        rtts = sorted(rtt[i] for i in range(count) if ok[i])
+        n = len(rtts)
+        lost_rate = float(count - n) / count if count else 0.0
+        if n == 0:
+            return {'lost_rate': lost_rate, 'count': count}
+
+        avg = sum(rtts) / n
+        var = sum((v - avg) ** 2 for v in rtts) / n
+
+        def pct(q):
+            return rtts[min(n - 1, int(q * n))]
+
+        return {
+            'lost_rate': round(lost_rate, 4),
+            'count': count,
+            'min': round(rtts[0], 2),
+            'avg': round(avg, 2),
+            'max': round(rtts[-1], 2),
+            'stddev': round(var ** 0.5, 2),
+            'jitter': round(sum(jit) / len(jit), 2) if jit else 0.0,
+            'p50': round(pct(0.50), 2),
+            'p95': round(pct(0.95), 2),
+            'p99': round(pct(0.99), 2),
+        }
+
+
+def parse_probe_target(spec, mark, interval=INTERVAL, timeout=1):
+    """mark=host:port[/interval[/timeout]]"""
+    if "=" in spec:
+        mark, spec = spec.split("=", 1)
+    addr, _, rest = spec.partition("/")
+    if rest:
+        arr = rest.split("/")
+        interval = float(arr[0])
+        if len(arr) > 1:
+            timeout = float(arr[1])
+    host, port = addr.rsplit(":", 1)
+    return {
+        'mark': mark.strip(),
+        'host': host.strip("[]"),
+        'port': int(port),
+        'interval': interval,
+        'timeout': timeout,
+    }
+
+
+async def _resolve(loop, host, port):
+    family = socket.AF_UNSPEC
+    if host.count(':') < 1:     # if not plain ipv6 address, means ipv4 address or hostname
+        family = socket.AF_INET if PROBE_PROTOCOL_PREFER == 'ipv4' else socket.AF_INET6
+    infos = await loop.getaddrinfo(host, port, family=family, type=socket.SOCK_STREAM)
+    family, _, _, _, sockaddr = infos[0]
+    return family, sockaddr
+
+
+async def _probe(target):
+    """tcp connect probe, resolve again every PROBE_RESOLVE_TTL seconds"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    mark = target['mark']
+    window = ProbeWindow()
+    addr, resolve_at = None, 0.0
+    stat = G_PROBES.setdefault(mark, {
+        'target': "{}:{}".format(target['host'], target['port']),
+        'lost_rate': 0.0,
+        'time': 0,
+        'window': window,
+    })
+
+    next_ts = loop.time()
     while True:
-        if packet_queue.full():
-            if packet_queue.get() == 0:
-                packet_lost -= 1
+        if loop.time() >= resolve_at:
+            try:
+                addr = await _resolve(loop, target['host'], target['port'])
+                resolve_at = loop.time() + PROBE_RESOLVE_TTL
+            except Exception as ex:
+                # eg: network not up yet at boot, keep the last good address, retry soon
+                print("resolve {} fail: {}".format(target['host'], ex))
+                resolve_at = loop.time() + PROBE_RESOLVE_RETRY
+
+        b = loop.time()
+        sock = None
         try:
-            b = timeit.default_timer()
-            socket.create_connection((ip, port), timeout=1).close()
-            G_PING_TIME[mark] = int((timeit.default_timer() - b) * 1000)
-            packet_queue.put(1)
-        except socket.error as error:
-            if error.errno == errno.ECONNREFUSED:
-                G_PING_TIME[mark] = int((timeit.default_timer() - b) * 1000)
-                packet_queue.put(1)
-            # elif error.errno == errno.ETIMEDOUT:
-            else:
-                packet_lost += 1
-                packet_queue.put(0)
+            if addr is None:
+                raise socket.gaierror("unresolved {}".format(target['host']))
+            sock = socket.socket(addr[0], socket.SOCK_STREAM)
+            sock.setblocking(False)
+            await asyncio.wait_for(loop.sock_connect(sock, addr[1]), target['timeout'])
+            window.push(True, (loop.time() - b) * 1000)
+        except ConnectionRefusedError:
+            window.push(True, (loop.time() - b) * 1000)
+        except (OSError, asyncio.TimeoutError):
+            window.push(False)
+        finally:
+            if sock is not None:
+                sock.close()
+
+        if window.last_rtt is not None:
+            stat['time'] = int(window.last_rtt)
+        if window.count > 30:
+            stat['lost_rate'] = window.lost_rate()
+
+        if mark in G_LOST_RATE:
+            G_LOST_RATE[mark] = stat['lost_rate']
+            G_PING_TIME[mark] = stat['time']
 
-        if packet_queue.qsize() > 30:
-            G_LOST_RATE[mark] = float(packet_lost) / packet_queue.qsize()
+        next_ts += target['interval']
+        await asyncio.sleep(max(0.0, next_ts - loop.time()))
 
-        time.sleep(INTERVAL)
 
+async def _probe_main(targets):
+    import asyncio
+    await asyncio.gather(*[_probe(target) for target in targets])
 
-def _net_speed(options):
+
+def _probe_thread(targets):
+    """run all probes concurrently on one event loop"""
+    # imported here, off the startup path
+    import asyncio
+    asyncio.run(_probe_main(targets))
+
+
+def get_net_speed(options):
+    """rx/tx bytes per second since the previous call"""
+    G_IFACES.update(options)
+    return G_IFACES.rates()
+
+
+
+def _pread_all(fd):
+    chunks, off = [], 0
     while True:
-        avgrx, avgtx = 0, 0
-        for name, stats in psutil.net_io_counters(pernic=True).items():
-            if skip_iface(name, options):
+        b = os.pread(fd, 65536, off)
+        if not b:
+            break
+        chunks.append(b)
+        off += len(b)
+    return b"".join(chunks)
+
+
+class HiresSampler:
+    """cpu/nic counters sampled at hz into preallocated ring arrays
+
+    each report gets min/max/avg/p95 over the samples taken since the previous one
+    """
+
+    FIELDS = ("cpu", "network_rx", "network_tx")
+
+    def __init__(self, hz, window, options):
+        self.hz = hz
+        self.options = options
+        # two windows, the writer never catches up with a reader that is late
+        self.size = max(2, int(hz * max(window, INTERVAL) * 2))
+        self.data = [array("d", bytes(8 * self.size)) for _ in self.FIELDS]
+        self.n = 0
+        self.read_n = 0
+        self.pre = None
+        self.fds = None
+        if sys.platform.startswith("linux"):
+            self.fds = (os.open("/proc/stat", os.O_RDONLY), os.open("/proc/net/dev", os.O_RDONLY))
+
+    def _counters(self):
+        """(busy, total, rx, tx), /proc via pread on linux"""
+        rx, tx = 0, 0
+        if self.fds is None:
+            busy, total = _cpu_busy_total(psutil.cpu_times())
+            for name, stats in psutil.net_io_counters(pernic=True).items():
+                if not skip_iface(name, self.options):
+                    rx += stats.bytes_recv
+                    tx += stats.bytes_sent
+            return busy, total, rx, tx
+        # user nice system idle iowait irq softirq steal, guest is part of user
+        # ticks are USER_HZ (100/s) summed over all cpus, fewer cpus => coarser cpu samples
+        t = [int(v) for v in _pread_all(self.fds[0]).split(b"\n", 1)[0].split()[1:9]]
+        total = sum(t)
+        busy = total - t[3] - t[4]
+        for line in _pread_all(self.fds[1]).split(b"\n")[2:]:
+            name, _, data = line.partition(b":")
+            if not data or skip_iface(name.strip().decode(), self.options):
                 continue
-            avgrx += stats.bytes_recv
-            avgtx += stats.bytes_sent
-        now_clock = time.time()
-        G_NET_SPEED["diff"] = now_clock - G_NET_SPEED["clock"]
-        G_NET_SPEED["clock"] = now_clock
-        G_NET_SPEED["netrx"] = int(
-            (avgrx - G_NET_SPEED["avgrx"]) / G_NET_SPEED["diff"])
-        G_NET_SPEED["nettx"] = int(
-            (avgtx - G_NET_SPEED["avgtx"]) / G_NET_SPEED["diff"])
-        G_NET_SPEED["avgrx"] = avgrx
-        G_NET_SPEED["avgtx"] = avgtx
-        time.sleep(INTERVAL)
+            data = data.split()
+            rx += int(data[0])
+            tx += int(data[8])
+        return busy, total, rx, tx
+
+    def tick(self):
+        now = time.monotonic()
+        cur = (now,) + self._counters()
+        pre, self.pre = self.pre, cur
+        if pre is None or now <= pre[0]:
+            return
+        dt = now - pre[0]
+        i = self.n % self.size
+        dtotal = cur[2] - pre[2]
+        self.data[0][i] = (cur[1] - pre[1]) * 100.0 / dtotal if dtotal > 0 else 0.0
+        self.data[1][i] = counter_delta(pre[3], cur[3]) / dt
+        self.data[2][i] = counter_delta(pre[4], cur[4]) / dt
+        self.n += 1
+
+    def run(self):
+        for _ in fixed_rate(1.0 / self.hz):
+            try:
+                self.tick()
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        """{field: {min, max, avg, p95, n}} since the previous call"""
+        n = self.n
+        count = min(n - self.read_n, self.size)
+        self.read_n = n
+        if count <= 0:
+            return None
+        start, end = (n - count) % self.size, n % self.size
+        o = {}
+        for name, arr in zip(self.FIELDS, self.data):
+            # slicing and sorted() stay in C, no per sample python code
+            w = arr[start:end] if start < end else arr[start:] + arr[:end]
+            v = sorted(w)
+            o[name] = {
+                'min': round(v[0], 2),
+                'max': round(v[-1], 2),
+                'avg': round(sum(v) / count, 2),
+                'p95': round(v[min(count - 1, int(0.95 * count))], 2),
+            }
+        o['n'] = count
+        return o
 
 
 def start_rt_collect_t(options):
     """realtime data collect"""
     t_list = []
     if not options.disable_ping:
+        targets = [
+            parse_probe_target(options.cu, '10010'),
+            parse_probe_target(options.ct, '189'),
+            parse_probe_target(options.cm, '10086'),
+        ]
+        for i, spec in enumerate(filter(len, map(str.strip, options.probe.split(",")))):
+            targets.append(parse_probe_target(spec, "probe_{}".format(i)))
         t_list.append(threading.Thread(
-            target=_ping_thread,
-            kwargs={
-                'target': options.cu,
-                'mark': '10010',
-            }
-        ))
-        t_list.append(threading.Thread(
-            target=_ping_thread,
+            target=_probe_thread,
             kwargs={
-                'target': options.ct,
-                'mark': '189',
-            }
-        ))
-        t_list.append(threading.Thread(
-            target=_ping_thread,
-            kwargs={
-                'target': options.cm,
-                'mark': '10086',
+                'targets': targets,
             }
         ))
 
-    # ip info
-    if not options.disable_extra:
-        t_list.append(threading.Thread(
-            target=refresh_ip_info,
-        ))
-
-    # net speed
+    # cpu, memory, disk, net speed, t/u/p/d, ip info ...
+    register_collectors(options)
+    # first pass inline, the first report does not wait for the scheduler thread
+    run_due_collectors(time.monotonic())
+    if options.hires > 0:
+        sampler = HiresSampler(options.hires, options.interval, options)
+        register_collector("hires", options.interval, sampler.stats)
+        t_list.append(threading.Thread(target=sampler.run))
     t_list.append(threading.Thread(
-        target=_net_speed,
-        kwargs={
-            'options': options,
-        }
+        target=_collector_thread,
     ))
 
     for t in t_list:
@@ -283,32 +703,189 @@ def byte_str(object):
         print(type(object))
 
 
-def sample(options, stat_base):
-    cpu_percent = int(get_cpu(options))
-    uptime = get_uptime()
-    load_1, load_5, load_15 = os.getloadavg(
-    ) if 'linux' in sys.platform else (0.0, 0.0, 0.0)
-    memory_total, memory_used, swap_total, swap_used = get_memory()
-    hdd_total, hdd_used = get_hdd()
+class CollectorTimer:
+    """per-collector wall/cpu time, and allocations when tracemalloc is tracing"""
+
+    def __init__(self, history=False):
+        self.last = {}
+        self.history = {} if history else None
+        # [start, peak before the last reset] of the calls in progress, nested calls reset the peak
+        self.frames = []
+
+    def call(self, name, func, *args):
+        import tracemalloc
+        trace = tracemalloc.is_tracing()
+        if trace:
+            mem0, peak = tracemalloc.get_traced_memory()
+            for frame in self.frames:
+                frame[1] = max(frame[1], peak)
+            tracemalloc.reset_peak()
+            frame = [mem0, 0]
+            self.frames.append(frame)
+        w0, c0 = time.perf_counter(), time.thread_time()
+        try:
+            return func(*args)
+        finally:
+            alloc = 0
+            if trace:
+                self.frames.pop()
+                alloc = max(frame[1], tracemalloc.get_traced_memory()[1]) - frame[0]
+            o = (time.perf_counter() - w0, time.thread_time() - c0, alloc)
+            self.last[name] = o
+            if self.history is not None:
+                self.history.setdefault(name, []).append(o)
 
-    stat_data = copy.deepcopy(stat_base)
 
-    stat_data['uptime'] = uptime
+G_TIMER = None
 
-    stat_data['load_1'] = load_1
-    stat_data['load_5'] = load_5
-    stat_data['load_15'] = load_15
 
-    stat_data['memory_total'] = memory_total
-    stat_data['memory_used'] = memory_used
-    stat_data['swap_total'] = swap_total
-    stat_data['swap_used'] = swap_used
-    stat_data['hdd_total'] = hdd_total
-    stat_data['hdd_used'] = hdd_used
-    stat_data['cpu'] = cpu_percent
+def collect(name, func, *args):
+    if G_TIMER is None:
+        return func(*args)
+    return G_TIMER.call(name, func, *args)
 
-    stat_data['network_rx'] = G_NET_SPEED.get("netrx")
-    stat_data['network_tx'] = G_NET_SPEED.get("nettx")
+
+def get_loadavg():
+    return os.getloadavg() if 'linux' in sys.platform else (0.0, 0.0, 0.0)
+
+
+class Collector:
+    """metric source with its own refresh period, the latest value is cached
+
+    fields: report key or tuple of keys the value is unpacked into,
+    None puts the value into custom[name]
+    """
+
+    def __init__(self, name, period, func, fields=None, default=None, blocking=False):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.fields = fields
+        self.default = default
+        # slow io (eg: http), run off the scheduler thread
+        self.blocking = blocking
+        self.value = None
+        self.next_ts = 0.0
+        self.running = False
+
+    def run(self):
+        self.running = True
+        try:
+            self.value = collect(self.name, self.func)
+        except Exception as ex:
+            traceback.print_exc()
+        finally:
+            self.running = False
+
+    def apply(self, stat_data, custom):
+        v = self.value if self.value is not None else self.default
+        if v is None:
+            return
+        if self.fields is None:
+            custom[self.name] = v
+        elif isinstance(self.fields, str):
+            stat_data[self.fields] = v
+        else:
+            stat_data.update(zip(self.fields, v))
+
+
+G_COLLECTORS = {}
+
+
+def register_collector(name, period, func, fields=None, default=None, blocking=False):
+    c = Collector(name, period, func, fields, default, blocking)
+    G_COLLECTORS[name] = c
+    return c
+
+
+def register_collectors(options):
+    """builtin collectors, period in seconds"""
+    G_COLLECTORS.clear()
+    interval = options.interval
+    register_collector("cpu", interval, get_cpu, "cpu", 0)
+    register_collector("uptime", interval, get_uptime, "uptime", 0)
+    register_collector("load", interval, get_loadavg,
+                       ("load_1", "load_5", "load_15"), (0.0, 0.0, 0.0))
+    register_collector("memory", interval, get_memory,
+                       ("memory_total", "memory_used", "swap_total", "swap_used"), (0, 0, 0, 0))
+    if options.cgroup:
+        global G_CGROUP
+        G_CGROUP = G_CGROUP or self_cgroup()
+        if G_CGROUP is None:
+            print("no cgroup found, report host cpu/memory")
+        else:
+            # no quota => the cpus we may run on, no limit => host size
+            ncpu = len(os.sched_getaffinity(0)) if hasattr(
+                os, "sched_getaffinity") else os.cpu_count() or 1
+            host = (psutil.virtual_memory().total, psutil.swap_memory().total)
+            register_collector("cpu", interval, lambda: get_cgroup_cpu(ncpu), "cpu", 0)
+            register_collector("memory", interval, lambda: G_CGROUP.memory(*host),
+                               ("memory_total", "memory_used", "swap_total", "swap_used"), (0, 0, 0, 0))
+            register_collector("psi", interval, G_CGROUP.pressure)
+    register_collector("hdd", options.hdd_interval, get_hdd,
+                       ("hdd_total", "hdd_used", "disks"), (0, 0, []))
+    register_collector("net_speed", INTERVAL, lambda: get_net_speed(options),
+                       ("network_rx", "network_tx"), (0, 0))
+    if options.vnstat:
+        def vnstat_traffic():
+            network_in, network_out, m_network_in, m_network_out = get_vnstat_traffic(options)
+            return network_in, network_out, network_in - m_network_in, network_out - m_network_out
+        register_collector("vnstat", interval, vnstat_traffic,
+                           ("network_in", "network_out", "last_network_in", "last_network_out"),
+                           (0, 0, 0, 0))
+    else:
+        register_collector("traffic", interval, lambda: get_sys_traffic(options),
+                           ("network_in", "network_out"), (0, 0))
+    register_collector("nics", interval, G_IFACES.nics)
+    if options.disable_tupd:
+        register_collector("tupd", float("inf"), lambda: (0, 0, 0, 0),
+                           ("tcp", "udp", "process", "thread"), (0, 0, 0, 0))
+    else:
+        register_collector("tupd", options.tupd_interval, tupd,
+                           ("tcp", "udp", "process", "thread"), (0, 0, 0, 0))
+    if not options.disable_extra:
+        c = register_collector("ip_info", 3600, refresh_ip_info, "ip_info", blocking=True)
+        # last known until the first lookup of this run returns
+        c.value = G_CACHE.get("ip_info")
+
+
+def run_due_collectors(now):
+    for c in list(G_COLLECTORS.values()):
+        if c.running or now < c.next_ts:
+            continue
+        c.next_ts = now + c.period
+        if c.blocking:
+            c.running = True
+            try:
+                threading.Thread(target=c.run, daemon=True).start()
+            except Exception:
+                c.running = False
+                raise
+        else:
+            c.run()
+
+
+def _collector_thread():
+    """single scheduler for all collectors"""
+    while True:
+        try:
+            run_due_collectors(time.monotonic())
+            # collectors may be registered from other threads meanwhile
+            next_ts = min([c.next_ts for c in list(G_COLLECTORS.values())] + [time.monotonic() + INTERVAL])
+        except Exception:
+            # eg: can't start a thread, the scheduler must not die with it
+            traceback.print_exc()
+            next_ts = time.monotonic() + INTERVAL
+        time.sleep(max(0.01, next_ts - time.monotonic()))
+
+
+def sample(options, stat_base):
+    """assemble a report from the latest collector values"""
+    # stat_base only holds scalars, a shallow copy is enough
+    stat_data = dict(stat_base)
+    custom = {}
+    for c in list(G_COLLECTORS.values()):
+        c.apply(stat_data, custom)
 
     stat_data['ping_10010'] = int(G_LOST_RATE.get('10010') * 100)
     stat_data['ping_189'] = int(G_LOST_RATE.get('189') * 100)
@@ -317,32 +894,68 @@ def sample(options, stat_base):
     stat_data['time_189'] = G_PING_TIME.get('189')
     stat_data['time_10086'] = G_PING_TIME.get('10086')
 
-    if options.vnstat:
-        (network_in, network_out, m_network_in,
-         m_network_out) = get_vnstat_traffic(options)
-        stat_data['network_in'] = network_in
-        stat_data['network_out'] = network_out
-        stat_data['last_network_in'] = network_in - m_network_in
-        stat_data['last_network_out'] = network_out - m_network_out
-    else:
-        net_in, net_out = get_sys_traffic(options)
-        stat_data['network_in'] = net_in
-        stat_data['network_out'] = net_out
-
-    if options.disable_tupd:
-        stat_data['tcp'], stat_data['udp'], stat_data['process'], stat_data['thread'] = 0, 0, 0, 0
-    else:
-        stat_data['tcp'], stat_data['udp'], stat_data['process'], stat_data['thread'] = tupd()
-
     if not options.disable_extra:
-        if G_IP_INFO:
-            stat_data['ip_info'] = G_IP_INFO
         if G_SYS_INFO:
             stat_data['sys_info'] = G_SYS_INFO
 
+    if G_PROBES:
+        custom['probe'] = {
+            mark: dict(target=o['target'], **o['window'].stats()) for mark, o in G_PROBES.items()}
+    if options.report_timings and G_TIMER is not None:
+        # ms, [wall, cpu]
+        custom['timings'] = {
+            k: [round(v[0] * 1000, 3), round(v[1] * 1000, 3)] for k, v in G_TIMER.last.items()}
+    if custom:
+        stat_data['custom'] = json.dumps(custom, separators=(',', ':'))
+
     return stat_data
 
 
+def bench(options, stat_base):
+    """run the collectors N times without posting, print per-collector cost"""
+    global G_TIMER
+    import tracemalloc
+    G_TIMER = CollectorTimer(history=True)
+    register_collectors(options)
+    # no network in the loop
+    collectors = [c for c in G_COLLECTORS.values() if not c.blocking]
+    encoder = ReportEncoder()
+    profiler = None
+    if len(options.profile) > 0:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    def once():
+        for c in collectors:
+            c.run()
+        collect("encode", encoder.json, sample(options, stat_base))
+
+    for _ in range(options.bench):
+        G_TIMER.call("total", once)
+        encoder.reset()
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
+        print("profile saved to {}, view with: python3 -m pstats {}".format(options.profile, options.profile))
+    tracemalloc.stop()
+
+    def pct(arr, q):
+        return arr[min(len(arr) - 1, int(q * len(arr)))]
+
+    print("{:<10} {:>6} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        "collector", "n", "wall p50", "wall p99", "wall avg", "cpu avg", "alloc peak"))
+    for name, items in G_TIMER.history.items():
+        walls = sorted(o[0] * 1000 for o in items)
+        cpu = sum(o[1] for o in items) * 1000 / len(items)
+        alloc = max(o[2] for o in items) / 1024.0
+        print("{:<10} {:>6} {:>8.3f}ms {:>8.3f}ms {:>8.3f}ms {:>8.3f}ms {:>9.1f}KiB".format(
+            name, len(items), pct(walls, 0.5), pct(walls, 0.99),
+            sum(walls) / len(walls), cpu, alloc))
+
+
 def get_target_network(url):
     ipv4, ipv6 = False, False
     arr = url.split("/")
@@ -363,10 +976,154 @@ def get_target_network(url):
     return ipv4, ipv6
 
 
-def http_report(options, stat_base):
-    socket.setdefaulttimeout(5)
-    start_rt_collect_t(options)
+def fixed_rate(interval):
+    """fixed-rate schedule, sampling time is not added to the period, first tick at once"""
+    next_ts = time.monotonic()
+    yield
+    while True:
+        next_ts += interval
+        delay = next_ts - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # fell behind, skip the missed ticks
+            next_ts = time.monotonic()
+        yield
+
+
+# report key, metric name, type, help, scale to base unit
+PROM_METRICS = (
+    ("uptime", "uptime_seconds", "gauge", "uptime", 1),
+    ("cpu", "cpu_usage_percent", "gauge", "cpu usage", 1),
+    ("load_1", "load1", "gauge", "1m load average", 1),
+    ("load_5", "load5", "gauge", "5m load average", 1),
+    ("load_15", "load15", "gauge", "15m load average", 1),
+    ("memory_total", "memory_total_bytes", "gauge", "memory total", 1024),
+    ("memory_used", "memory_used_bytes", "gauge", "memory used", 1024),
+    ("swap_total", "swap_total_bytes", "gauge", "swap total", 1024),
+    ("swap_used", "swap_used_bytes", "gauge", "swap used", 1024),
+    ("hdd_total", "hdd_total_bytes", "gauge", "disk total", 1024 * 1024),
+    ("hdd_used", "hdd_used_bytes", "gauge", "disk used", 1024 * 1024),
+    ("network_rx", "network_receive_bytes_per_second", "gauge", "rx rate", 1),
+    ("network_tx", "network_transmit_bytes_per_second", "gauge", "tx rate", 1),
+    ("network_in", "network_receive_bytes", "counter", "rx bytes", 1),
+    ("network_out", "network_transmit_bytes", "counter", "tx bytes", 1),
+    ("tcp", "tcp_connections", "gauge", "tcp connections", 1),
+    ("udp", "udp_sockets", "gauge", "udp sockets", 1),
+    ("process", "processes", "gauge", "processes", 1),
+    ("thread", "threads", "gauge", "threads", 1),
+    ("online4", "online4", "gauge", "ipv4 reachable", 1),
+    ("online6", "online6", "gauge", "ipv6 reachable", 1),
+)
+PROM_PREFIX = "stat_"
+
+
+def _prom_label(v):
+    return str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prom_render(stat_data):
+    """OpenMetrics text of a report"""
+    labels = 'name="{}"'.format(_prom_label(stat_data.get("name", "")))
+    lines = []
+
+    def family(name, kind, help):
+        lines.append("# HELP {}{} {}".format(PROM_PREFIX, name, help))
+        lines.append("# TYPE {}{} {}".format(PROM_PREFIX, name, kind))
+
+    for key, name, kind, help, scale in PROM_METRICS:
+        if key not in stat_data:
+            continue
+        family(name, kind, help)
+        lines.append("{}{}{}{{{}}} {}".format(
+            PROM_PREFIX, name, "_total" if kind == "counter" else "", labels,
+            float(stat_data[key]) * scale))
+
+    custom = json.loads(stat_data.get("custom") or "{}")
+    probes = dict(custom.get("probe", {}))
+    for mark in ("10010", "189", "10086"):
+        if "ping_" + mark in stat_data and mark not in probes:
+            probes[mark] = {"lost_rate": stat_data["ping_" + mark] / 100.0,
+                            "avg": stat_data["time_" + mark]}
+    if probes:
+        family("probe_lost_ratio", "gauge", "tcp probe loss ratio")
+        for mark, o in sorted(probes.items()):
+            lines.append('{}probe_lost_ratio{{{},probe="{}"}} {}'.format(
+                PROM_PREFIX, labels, _prom_label(mark), float(o.get("lost_rate", 0))))
+        family("probe_rtt_seconds", "gauge", "tcp probe rtt")
+        for mark, o in sorted(probes.items()):
+            if "avg" in o:
+                lines.append('{}probe_rtt_seconds{{{},probe="{}"}} {}'.format(
+                    PROM_PREFIX, labels, _prom_label(mark), o["avg"] / 1000.0))
+    nics = custom.get("nics", [])
+    for key, name, help in (("in", "nic_receive_bytes", "rx bytes per iface"),
+                            ("out", "nic_transmit_bytes", "tx bytes per iface")):
+        if nics:
+            family(name, "counter", help)
+        for o in nics:
+            lines.append('{}{}_total{{{},iface="{}"}} {}'.format(
+                PROM_PREFIX, name, labels, _prom_label(o["name"]), float(o[key])))
+    lines.append("# EOF\n")
+    return "\n".join(lines).encode("utf-8")
+
+
+class MetricsServer:
+    """--metrics listener, renders cached collector values at most once per INTERVAL"""
+
+    def __init__(self, options, stat_base):
+        self.options = options
+        self.stat_base = stat_base
+        self.lock = threading.Lock()
+        self.ts = 0.0
+        self.body = b""
+        self.gz = b""
+
+    def render(self):
+        """(plain, gzip) body, sample() only reads the collector caches"""
+        import gzip
+        with self.lock:
+            now = time.monotonic()
+            if now - self.ts >= INTERVAL:
+                self.body = prom_render(sample(self.options, self.stat_base))
+                self.gz = gzip.compress(self.body, 6)
+                self.ts = now
+            return self.body, self.gz
+
+    def serve(self):
+        import http.server
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body, gz = server.render()
+                self.send_response(200)
+                if "openmetrics" in self.headers.get("Accept", ""):
+                    self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                else:
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gz
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        host, _, port = self.options.metrics.rpartition(":")
+        httpd = http.server.ThreadingHTTPServer((host or "0.0.0.0", int(port)), Handler)
+        httpd.daemon_threads = True
+        print("metrics on http://{}:{}/metrics".format(host or "0.0.0.0", port))
+        httpd.serve_forever()
 
+
+def detect_network(options, stat_base):
     online4 = get_network(4)
     online6 = get_network(6)
     if not any([online4, online6]):
@@ -377,64 +1134,845 @@ def http_report(options, stat_base):
 
     stat_base['online4'] = online4
     stat_base['online6'] = online6
+    save_cache(online=[online4, online6])
+
+
+def init_report(options, stat_base):
+    """start collectors, detect online4/6, return (ssr_auth, auth_user)"""
+    socket.setdefaulttimeout(5)
+    start_rt_collect_t(options)
+
+    if "online" in G_CACHE:
+        # last known, checked again off the startup path
+        stat_base['online4'], stat_base['online6'] = G_CACHE["online"]
+        threading.Thread(target=detect_network, args=(options, stat_base), daemon=True).start()
+    else:
+        detect_network(options, stat_base)
+
+    if len(options.metrics) > 0:
+        threading.Thread(target=MetricsServer(options, stat_base).serve, daemon=True).start()
 
     ssr_auth = "single"
     auth_user = options.username
     if len(options.gid) > 0:
         ssr_auth = "group"
         auth_user = options.gid
+    return ssr_auth, auth_user
+
+
+class ReportEncoder:
+    """report encoder, static fields are only sent on (re)connect or change"""
+    STATIC_FIELDS = ("sys_info", "ip_info", "disks")
+    STATIC_RESEND_INTERVAL = 600
+
+    def __init__(self):
+        self.sent = {}
+        self.pending = {}
+        self.sent_ts = 0.0
+        # the last report left static fields out, connections the transport had opened by then
+        self.stripped = False
+        self.connects = 0
+        self._json = json.JSONEncoder(
+            ensure_ascii=False, check_circular=False, separators=(",", ":"))
+
+    def reset(self):
+        """call on (re)connect or error, static fields go out with the next report"""
+        self.sent.clear()
+
+    def strip(self, stat_data):
+        if time.monotonic() - self.sent_ts > self.STATIC_RESEND_INTERVAL:
+            self.reset()
+        self.pending = {}
+        self.stripped = False
+        for k in self.STATIC_FIELDS:
+            v = stat_data.get(k)
+            if v is None:
+                continue
+            if k in self.sent and self.sent[k] == v:
+                del stat_data[k]
+                self.stripped = True
+            else:
+                self.pending[k] = v
+        return stat_data
+
+    def ack(self, connects=0):
+        """the last report was accepted, connects: connections opened by the transport so far
+
+        urllib3 and grpc reconnect silently, a new connection may lead to a
+        restarted server that has no static fields of this host yet
+        """
+        if connects != self.connects:
+            self.connects = connects
+            if self.stripped:
+                self.reset()
+                return
+        if self.pending:
+            if not self.sent:
+                self.sent_ts = time.monotonic()
+            self.sent.update(self.pending)
+            self.pending = {}
+
+    def json(self, stat_data):
+        return self._json.encode(self.strip(stat_data)).encode("utf-8")
+
+    def pb(self, stat_data):
+        return bytes(pb_encode(self.strip(stat_data)))
+
+
+class Backoff:
+    """exponential backoff with jitter"""
+
+    def __init__(self, base=1.0, cap=60.0):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+        self.retry_ts = 0.0
+
+    def ready(self):
+        return time.monotonic() >= self.retry_ts
+
+    def fail(self):
+        delay = min(self.cap, self.base * (2 ** self.failures))
+        self.failures += 1
+        # half fixed, half random, so clients do not retry in the same second
+        self.retry_ts = time.monotonic() + delay / 2 + random.uniform(0, delay / 2)
 
-    http_headers = {"ssr-auth": ssr_auth}
+    def reset(self):
+        self.failures = 0
+        self.retry_ts = 0.0
+
+
+class HttpTransport:
+    """pooled keep-alive session for /report, kept across errors
+
+    bodies are compressed with --compress, rtt/retries/bytes go into custom.transport
+    """
+
+    # rebuild the pool after this many failures in a row
+    MAX_FAILURES = 3
+    # smaller bodies go out as is
+    COMPRESS_MIN = 256
+
+    def __init__(self, options):
+        self.options = options
+        self.compressor = None
+        if options.compress == "gzip":
+            import gzip
+            self.compressor = lambda b: gzip.compress(b, 5)
+        elif options.compress == "zstd":
+            # pip3 install zstandard
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=3).compress
+        self.sess = None
+        self.failures = 0
+        # new connections, see ReportEncoder.ack
+        self.connects = 0
+        self.rtt = 0.0
+        self.posts = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_raw = 0
+        self.connect()
+
+    def connect(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+        opts = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        for opt, v in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, opt):
+                opts.append((socket.IPPROTO_TCP, getattr(socket, opt), v))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        adapter.init_poolmanager(1, 2, socket_options=opts)
+        transport = self
+
+        def counted(pool_cls, conn_cls):
+            class Connection(conn_cls):
+                def connect(self):
+                    super().connect()
+                    transport.connects += 1
+            return type(pool_cls.__name__, (pool_cls,), {"ConnectionCls": Connection})
+
+        adapter.poolmanager.pool_classes_by_scheme = {
+            "http": counted(HTTPConnectionPool, HTTPConnection),
+            "https": counted(HTTPSConnectionPool, HTTPSConnection),
+        }
+        if self.sess is not None:
+            self.sess.close()
+        self.sess = requests.Session()
+        self.sess.mount("http://", adapter)
+        self.sess.mount("https://", adapter)
+
+    def post(self, body, auth, headers):
+        import requests
+        self.bytes_raw += len(body)
+        if self.compressor is not None and len(body) >= self.COMPRESS_MIN:
+            body = self.compressor(body)
+            headers = dict(headers, **{"Content-Encoding": self.options.compress})
+        b = time.monotonic()
+        try:
+            try:
+                r = self.sess.post(self.options.addr, auth=auth, data=body, headers=headers, timeout=10)
+            except requests.ConnectionError:
+                # pooled connection closed by the server or a middlebox while idle
+                self.retries += 1
+                r = self.sess.post(self.options.addr, auth=auth, data=body, headers=headers, timeout=10)
+            if self.options.debug or not r.ok:
+                print(r)
+            r.raise_for_status()
+        except Exception:
+            self.failures += 1
+            if self.failures >= self.MAX_FAILURES:
+                self.failures = 0
+                self.connect()
+            raise
+        rtt = (time.monotonic() - b) * 1000
+        self.rtt = rtt if self.posts == 0 else self.rtt * 0.8 + rtt * 0.2
+        self.posts += 1
+        self.failures = 0
+        self.bytes_sent += len(body)
+        return r
+
+    def stats(self):
+        return {
+            "rtt": round(self.rtt, 2),
+            "posts": self.posts,
+            "retries": self.retries,
+            "bytes": self.bytes_sent,
+            "raw_bytes": self.bytes_raw,
+        }
+
+
+class LatestSender:
+    """posts from its own thread, sampling never waits on the server
+
+    the server keeps no history, only the newest report is kept, a report not
+    sent yet when the next one comes is superseded
+    """
+
+    def __init__(self, send):
+        # send(item) runs on the sender thread, raises on failure
+        self.send = send
+        self.cond = threading.Condition()
+        self.item = None
+        self.superseded = 0
+        self.backoff = Backoff()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, item):
+        with self.cond:
+            if self.item is not None:
+                self.superseded += 1
+            self.item = item
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            delay = self.backoff.retry_ts - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.cond:
+                while self.item is None:
+                    self.cond.wait()
+                item, self.item = self.item, None
+            try:
+                self.send(item)
+                self.backoff.reset()
+            except Exception as ex:
+                traceback.print_exc()
+                self.backoff.fail()
+
+
+def http_report(options, stat_base):
+    from requests.auth import HTTPBasicAuth
+    ssr_auth, auth_user = init_report(options, stat_base)
+
+    http_headers = {"ssr-auth": ssr_auth,
+                    "Content-Type": "application/json"}
     auth = HTTPBasicAuth(auth_user, options.password)
     print(http_headers, auth)
-    sess = requests.Session()
-    while True:
+    # only used on the sender thread
+    encoder = ReportEncoder()
+    transport = HttpTransport(options)
+
+    def send(stat_data):
+        body = encoder.json(stat_data)
+        if options.debug:
+            print(body.decode("utf-8"))
+        try:
+            transport.post(body, auth, http_headers)
+        except Exception:
+            encoder.reset()
+            raise
+        encoder.ack(transport.connects)
+
+    sender = LatestSender(send)
+    register_collector("transport", options.interval,
+                       lambda: dict(transport.stats(), superseded=sender.superseded))
+    for _ in fixed_rate(options.interval):
         try:
             stat_data = sample(options, stat_base)
-            print(json.dumps(stat_data))
-            r = sess.post(options.addr, auth=auth,
-                          json=stat_data, headers=http_headers)
-            print(r)
+            stat_data['latest_ts'] = int(time.time())
+            sender.submit(stat_data)
         except KeyboardInterrupt:
             raise
         except Exception as ex:
             traceback.print_exc()
-            time.sleep(3)
-            sess = requests.Session()
 
 
-IP_API_URL = "http://ip-api.com/json?fields=status,message,continent,continentCode,country,countryCode,region,regionName,city,district,zip,lat,lon,timezone,isp,org,as,asname,query&lang=zh-CN"
+# server_status.proto, (key, field number, type), nested messages are field tuples
+PB_SYS_INFO = (
+    ("name", 1, "string"), ("version", 2, "string"),
+    ("os_name", 3, "string"), ("os_arch", 4, "string"), ("os_family", 5, "string"),
+    ("os_release", 6, "string"), ("kernel_version", 7, "string"),
+    ("cpu_num", 8, "uint"), ("cpu_brand", 9, "string"), ("cpu_vender_id", 10, "string"),
+    ("host_name", 11, "string"),
+)
+PB_IP_INFO = (
+    ("query", 1, "string"), ("source", 2, "string"),
+    ("continent", 3, "string"), ("country", 4, "string"),
+    ("region_name", 5, "string"), ("city", 6, "string"),
+    ("isp", 7, "string"), ("org", 8, "string"), ("as", 9, "string"), ("asname", 10, "string"),
+    ("lat", 11, "double"), ("lon", 12, "double"), ("timezone", 13, "string"),
+)
+PB_DISK_INFO = (
+    ("name", 1, "string"), ("mount_point", 2, "string"), ("file_system", 3, "string"),
+    ("total", 4, "uint"), ("used", 5, "uint"), ("free", 6, "uint"),
+)
+PB_STAT_REQUEST = (
+    ("name", 1, "string"), ("version", 2, "string"), ("latest_ts", 3, "uint"),
+    ("frame", 4, "string"), ("vnstat", 6, "bool"),
+    ("online4", 7, "bool"), ("online6", 8, "bool"), ("uptime", 9, "uint"),
+    ("load_1", 10, "double"), ("load_5", 11, "double"), ("load_15", 12, "double"),
+    ("ping_10010", 13, "double"), ("ping_189", 14, "double"), ("ping_10086", 15, "double"),
+    ("time_10010", 16, "double"), ("time_189", 17, "double"), ("time_10086", 18, "double"),
+    ("tcp", 19, "uint"), ("udp", 20, "uint"), ("process", 21, "uint"), ("thread", 22, "uint"),
+    ("network_rx", 23, "uint"), ("network_tx", 24, "uint"),
+    ("network_in", 25, "uint"), ("network_out", 26, "uint"),
+    ("last_network_in", 27, "uint"), ("last_network_out", 28, "uint"),
+    ("cpu", 29, "double"), ("memory_total", 30, "uint"), ("memory_used", 31, "uint"),
+    ("swap_total", 32, "uint"), ("swap_used", 33, "uint"),
+    ("hdd_total", 34, "uint"), ("hdd_used", 35, "uint"),
+    ("custom", 36, "string"), ("sys_info", 37, PB_SYS_INFO), ("ip_info", 38, PB_IP_INFO),
+    ("gid", 39, "string"), ("alias", 40, "string"), ("weight", 41, "uint"),
+    ("type", 42, "string"), ("location", 43, "string"), ("notify", 44, "bool"),
+    ("si", 45, "bool"), ("disks", 46, PB_DISK_INFO),
+)
+
+
+def _pb_varint(n, out):
+    n &= 0xFFFFFFFFFFFFFFFF
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def pb_encode(data, fields=PB_STAT_REQUEST, out=None):
+    """encode a dict as protobuf, proto3 defaults are skipped"""
+    if out is None:
+        out = bytearray()
+    for key, num, kind in fields:
+        v = data.get(key)
+        if v is None:
+            continue
+        if isinstance(kind, tuple):
+            for item in (v if isinstance(v, list) else [v]):
+                sub = pb_encode(item, kind)
+                _pb_varint(num << 3 | 2, out)
+                _pb_varint(len(sub), out)
+                out += sub
+        elif kind == "string":
+            if key != "custom" and not v:
+                continue
+            b = v.encode("utf-8")
+            _pb_varint(num << 3 | 2, out)
+            _pb_varint(len(b), out)
+            out += b
+        elif kind == "double":
+            if not v:
+                continue
+            _pb_varint(num << 3 | 1, out)
+            out += struct.pack("<d", float(v))
+        else:  # uint/bool
+            v = int(v)
+            if not v:
+                continue
+            _pb_varint(num << 3, out)
+            _pb_varint(v, out)
+    return out
 
 
-def refresh_ip_info():
-    """ip info"""
+def _pb_read_varint(buf, i):
+    v, shift = 0, 0
     while True:
+        b = buf[i]
+        i += 1
+        v |= (b & 0x7F) << shift
+        shift += 7
+        if b < 0x80:
+            return v, i
+
+
+def pb_decode_response(buf):
+    """server_status.Response => (code, message)"""
+    code, message, i = 0, "", 0
+    while i < len(buf):
+        key, i = _pb_read_varint(buf, i)
+        num, wire = key >> 3, key & 7
+        if wire == 0:
+            v, i = _pb_read_varint(buf, i)
+            if num == 1:
+                code = v - (1 << 64) if v >= 1 << 63 else v
+        elif wire == 2:
+            n, i = _pb_read_varint(buf, i)
+            if num == 2:
+                message = bytes(buf[i:i + n]).decode("utf-8", "replace")
+            i += n
+        else:
+            break
+    return code, message
+
+
+def grpc_channel(options):
+    """grpc://host:port, grpcs://host:port, --mtls with ca.pem/client.pem/client.key in --tls-dir"""
+    # pip3 install grpcio
+    import grpc
+
+    scheme, target = options.addr.split("://", 1)
+    target = target.rstrip("/")
+    channel_opts = [
+        ("grpc.keepalive_time_ms", 30000),
+        ("grpc.keepalive_timeout_ms", 5000),
+    ]
+    if options.mtls:
+        def read(name):
+            with open(os.path.join(options.tls_dir, name), "rb") as f:
+                return f.read()
+        creds = grpc.ssl_channel_credentials(
+            root_certificates=read("ca.pem"),
+            private_key=read("client.key"),
+            certificate_chain=read("client.pem"))
+        return grpc.secure_channel(target, creds, channel_opts)
+    if scheme == "grpcs":
+        return grpc.secure_channel(target, grpc.ssl_channel_credentials(), channel_opts)
+    return grpc.insecure_channel(target, channel_opts)
+
+
+def grpc_report(options, stat_base):
+    ssr_auth, auth_user = init_report(options, stat_base)
+
+    metadata = (
+        ("authorization", "{}@_@{}".format(auth_user, options.password)),
+        ("ssr-auth", ssr_auth),
+    )
+    import grpc
+    channel = grpc_channel(options)
+    # raw bytes in/out, the messages are encoded by pb_encode/pb_decode_response
+    report = channel.unary_unary("/server_status.ServerStatus/Report")
+    # the channel reconnects on its own, count the connections for ReportEncoder.ack
+    connects = [0]
+
+    def on_state(state):
+        if state == grpc.ChannelConnectivity.READY:
+            connects[0] += 1
+
+    channel.subscribe(on_state)
+    # only used on the sender thread
+    encoder = ReportEncoder()
+
+    def send(stat_data):
+        if options.debug:
+            print(json.dumps(stat_data))
         try:
-            r = requests.get(IP_API_URL, timeout=5)
-            resp = r.json()
-            # print(json.dumps(resp, indent=2))
-            ip_info = {
-                "query": resp.get("query", "unknown"),
-                "source": "ip-api.com",
-                "continent": resp.get("continent", "unknown"),
-                "country": resp.get("country", "unknown"),
-                "region_name": resp.get("regionName", "unknown"),
-                "city": resp.get("city", "unknown"),
-                "isp": resp.get("isp", "unknown"),
-                "org": resp.get("org", "unknown"),
-                "as": resp.get("as", "unknown"),
-                "asname": resp.get("asname", "unknown"),
-                "lat": resp.get("lat", 0),
-                "lon": resp.get("lon", 0),
-                "timezone": resp.get("timezone", "Asia/Shanghai"),
-            }
-            # print(json.dumps(ip_info, indent=2))
-            global G_IP_INFO
-            G_IP_INFO = ip_info
+            resp = report(encoder.pb(stat_data), metadata=metadata, timeout=3)
+        except Exception:
+            encoder.reset()
+            raise
+        encoder.ack(connects[0])
+        if options.debug:
+            print(pb_decode_response(resp))
+
+    sender = LatestSender(send)
+    register_collector("transport", options.interval,
+                       lambda: {"superseded": sender.superseded})
+    for _ in fixed_rate(options.interval):
+        try:
+            sender.submit(sample(options, stat_base))
+        except KeyboardInterrupt:
+            raise
         except Exception as ex:
             traceback.print_exc()
-        # /1h
-        time.sleep(3600)
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+class CgroupFiles:
+    """cgroup interface files held open, re-read with os.pread every tick"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fds = {}
+
+    def read(self, name):
+        """file content as str, None if the file does not exist"""
+        fd = self.fds.get(name)
+        if fd is not None:
+            try:
+                return _pread_all(fd).decode()
+            except OSError:
+                # cgroup removed (ENODEV), maybe re-created under the same path
+                os.close(self.fds.pop(name))
+        try:
+            fd = os.open(os.path.join(self.path, name), os.O_RDONLY)
+        except OSError:
+            return None
+        self.fds[name] = fd
+        return _pread_all(fd).decode()
+
+    def keyed(self, name):
+        """flat keyed file, eg: cpu.stat, memory.stat"""
+        o = {}
+        for line in (self.read(name) or "").splitlines():
+            arr = line.split()
+            if len(arr) == 2:
+                o[arr[0]] = int(arr[1])
+        return o
+
+    def value(self, name, default=None):
+        """single value file, `max` => default"""
+        v = (self.read(name) or "").strip()
+        return int(v) if v.isdigit() else default
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
+
+def _psi(text):
+    """memory.pressure/cpu.pressure, {"some": [avg10, avg60, avg300], "full": [...]}"""
+    o = {}
+    for line in (text or "").splitlines():
+        arr = line.split()
+        if arr:
+            o[arr[0]] = [float(kv.partition("=")[2]) for kv in arr[1:4]]
+    return o
+
+
+class CgroupStats:
+    """cpu/memory/psi of one cgroup, v2 dir or v1 {controller: dir}"""
+
+    def __init__(self, path=None, v1=None):
+        self.v1 = v1 is not None
+        if self.v1:
+            self.cpu = CgroupFiles(v1.get("cpu", ""))
+            self.cpuacct = CgroupFiles(v1.get("cpuacct", ""))
+            self.mem = CgroupFiles(v1.get("memory", ""))
+            # no per cgroup psi on v1, system wide if the kernel has it
+            self.psi = CgroupFiles("/proc/pressure")
+        else:
+            self.files = self.cpu = self.cpuacct = self.mem = CgroupFiles(path)
+        self.pre = None
+
+    def cpu_usage(self):
+        """cumulative cpu time, seconds"""
+        if self.v1:
+            return self.cpuacct.value("cpuacct.usage", 0) / 1e9
+        return self.cpu.keyed("cpu.stat").get("usage_usec", 0) / 1e6
+
+    def cpu_cores(self, default):
+        """cpu quota in cores, no quota => default"""
+        if self.v1:
+            quota = self.cpu.value("cpu.cfs_quota_us")
+            period = self.cpu.value("cpu.cfs_period_us")
+        else:
+            quota, period = ((self.cpu.read("cpu.max") or "max 100000").split() + [None])[:2]
+            quota = int(quota) if quota.isdigit() else None
+            period = int(period) if period and period.isdigit() else None
+        return quota / period if quota and period else default
+
+    def cpu_percent(self, cores):
+        """usage relative to the quota since the previous call"""
+        now, usage = time.monotonic(), self.cpu_usage()
+        pre, self.pre = self.pre, (now, usage)
+        if pre is None or now <= pre[0]:
+            return 0.0
+        return min(100.0, max(0.0, (usage - pre[1]) / (now - pre[0]) / cores * 100))
+
+    def memory(self, host_mem, host_swap):
+        """KiB (total, used, swap total, swap used), no limit => host size in bytes"""
+        mem = self.mem
+        if self.v1:
+            usage = mem.value("memory.usage_in_bytes", 0)
+            used = usage - mem.keyed("memory.stat").get("total_inactive_file", 0)
+            # unlimited is reported as a huge page aligned number
+            limit = min(mem.value("memory.limit_in_bytes", host_mem), host_mem)
+            memsw = mem.value("memory.memsw.limit_in_bytes")
+            swap_total = min(memsw - limit, host_swap) if memsw else 0
+            swap_used = max(0, mem.value("memory.memsw.usage_in_bytes", usage) - usage)
+        else:
+            used = mem.value("memory.current", 0) - mem.keyed("memory.stat").get("inactive_file", 0)
+            limit = mem.value("memory.max", host_mem)
+            swap_total = mem.value("memory.swap.max", host_swap)
+            swap_used = mem.value("memory.swap.current", 0)
+        return limit // 1024, max(0, used) // 1024, swap_total // 1024, swap_used // 1024
+
+    def pressure(self):
+        if self.v1:
+            return {k: _psi(self.psi.read(k)) for k in ("cpu", "memory", "io")}
+        return {k: _psi(self.cpu.read(k + ".pressure")) for k in ("cpu", "memory", "io")}
+
+    def close(self):
+        for f in set([self.cpu, self.cpuacct, self.mem, getattr(self, "psi", self.cpu)]):
+            f.close()
+
+
+def _cgroup_mounts():
+    """{controller: (root, mount point)}, "" for the v2 hierarchy"""
+    o = {}
+    with open(MOUNTINFO_PATH, "r") as f:
+        for line in f:
+            left, _, right = line.partition(" - ")
+            arr, fs = left.split(), right.split()
+            if len(arr) < 5 or len(fs) < 3:
+                continue
+            if fs[0] == "cgroup2":
+                o.setdefault("", (arr[3], arr[4]))
+            elif fs[0] == "cgroup":
+                for c in fs[2].split(","):
+                    o.setdefault(c, (arr[3], arr[4]))
+    return o
+
+
+def self_cgroup():
+    """CgroupStats of the cgroup this process runs in, None if not available"""
+    try:
+        mounts = _cgroup_mounts()
+        with open("/proc/self/cgroup", "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    paths = {}
+    for line in lines:
+        _, ctrls, path = line.split(":", 2)
+        for c in (ctrls.split(",") if ctrls else [""]):
+            if c not in mounts:
+                continue
+            root, mnt = mounts[c]
+            # inside a cgroup namespace or bind mount, the mount root is our own cgroup
+            if root != "/" and path != root and not path.startswith(root + "/"):
+                path = root
+            paths[c] = os.path.normpath(os.path.join(mnt, os.path.relpath(path, root)))
+    # hybrid hosts mount the v2 hierarchy without controllers, v1 wins there
+    if "memory" in paths or "cpuacct" in paths:
+        return CgroupStats(v1=paths)
+    if "" in paths:
+        return CgroupStats(paths[""])
+    return None
+
+
+def _netns_dev(pid, options):
+    """rx/tx bytes of the netns pid lives in"""
+    rx, tx = 0, 0
+    with open("/proc/{}/net/dev".format(pid), "rb") as f:
+        for line in f.read().split(b"\n")[2:]:
+            name, _, data = line.partition(b":")
+            if not data:
+                continue
+            name = name.strip().decode()
+            if name == "lo" or skip_iface(name, options):
+                continue
+            data = data.split()
+            rx += int(data[0])
+            tx += int(data[8])
+    return rx, tx
+
+
+class Tenant:
+    """container/tenant reported under its own name, from cgroup v2 and its netns"""
+
+    def __init__(self, conf, options, stat_base):
+        self.options = options
+        path = conf["cgroup"]
+        if not os.path.isabs(path):
+            path = os.path.join(CGROUP_ROOT, path)
+        self.cg = CgroupStats(path)
+        self.base = dict(stat_base)
+        self.base['name'] = conf["name"]
+        self.base['gid'] = conf.get("gid", options.gid)
+        self.base['alias'] = conf.get("alias", conf["name"]) if self.base['gid'] else ""
+        for k in ("type", "location", "weight"):
+            if k in conf:
+                self.base[k] = conf[k]
+        if self.base['gid']:
+            self.auth = ("group", self.base['gid'], conf.get("password", options.password))
+        else:
+            self.auth = ("single", conf["name"], conf.get("password", options.password))
+        self.encoder = ReportEncoder()
+        self.pre = None
+
+    def sample(self, host_data):
+        """shared host fields (load, hdd, ping ...) come from host_data
+
+        None while the cgroup does not exist (container stopped or restarting)
+        """
+        cg = self.cg.files
+        if not os.path.isdir(cg.path):
+            if self.pre is not None:
+                print("tenant {}: cgroup {} gone".format(self.base['name'], cg.path))
+                cg.close()
+                self.pre = None
+                self.cg.pre = None
+            return None
+        now = time.monotonic()
+        stat_data = dict(host_data)
+        stat_data.update(self.base)
+        for k in ("sys_info", "disks", "custom"):
+            stat_data.pop(k, None)
+
+        pids = [int(pid) for pid in (cg.read("cgroup.procs") or "").split()]
+        io = [0, 0]
+        for line in (cg.read("io.stat") or "").splitlines():
+            for kv in line.split()[1:]:
+                k, _, v = kv.partition("=")
+                if k == "rbytes":
+                    io[0] += int(v)
+                elif k == "wbytes":
+                    io[1] += int(v)
+        rx, tx = 0, 0
+        if pids:
+            try:
+                rx, tx = _netns_dev(min(pids), self.options)
+            except OSError:
+                pass
+
+        cur = (now, rx, tx, io[0], io[1])
+        netrx, nettx, read_bps, write_bps = 0, 0, 0, 0
+        if self.pre is not None and now > self.pre[0]:
+            dt = now - self.pre[0]
+            netrx, nettx, read_bps, write_bps = (
+                int(max(0, cur[i] - self.pre[i]) / dt) for i in range(1, 5))
+        self.pre = cur
+
+        # cpu quota in cores, `max` => all host cpus
+        stat_data['cpu'] = int(self.cg.cpu_percent(self.cg.cpu_cores(os.cpu_count() or 1)))
+        (stat_data['memory_total'], stat_data['memory_used'],
+         stat_data['swap_total'], stat_data['swap_used']) = self.cg.memory(
+            host_data['memory_total'] * 1024, host_data['swap_total'] * 1024)
+        stat_data['network_rx'] = netrx
+        stat_data['network_tx'] = nettx
+        stat_data['network_in'] = rx
+        stat_data['network_out'] = tx
+        stat_data['process'] = len(pids)
+        stat_data['thread'] = cg.value("pids.current", 0)
+        if pids:
+            stat_data['tcp'] = _count_proc_net(["/proc/{}/net/{}".format(min(pids), f)
+                                                for f in ("tcp", "tcp6")])
+            stat_data['udp'] = _count_proc_net(["/proc/{}/net/{}".format(min(pids), f)
+                                                for f in ("udp", "udp6")])
+            try:
+                with open("/proc/{}/stat".format(min(pids)), "r") as f:
+                    start = int(f.read().rsplit(")", 1)[1].split()[19])
+                stat_data['uptime'] = max(0, int(host_data['uptime'] - start / os.sysconf("SC_CLK_TCK")))
+            except (OSError, ValueError, IndexError):
+                pass
+        else:
+            stat_data['tcp'], stat_data['udp'] = 0, 0
+        stat_data['custom'] = json.dumps(
+            {"io": {"read_bps": read_bps, "write_bps": write_bps}, "psi": self.cg.pressure()},
+            separators=(',', ':'))
+        return stat_data
+
+
+def load_tenants(options, stat_base):
+    """--tenants file, json list of {"name", "cgroup", "alias"?, "gid"?, "password"?}"""
+    with open(options.tenants, "r") as f:
+        return [Tenant(conf, options, stat_base) for conf in json.load(f)]
+
+
+def tenants_report(options, stat_base):
+    """one process reports the host and every tenant over one pooled session"""
+    from requests.auth import HTTPBasicAuth
+    ssr_auth, auth_user = init_report(options, stat_base)
+    tenants = load_tenants(options, stat_base)
+    print("tenants: {}".format([t.base['name'] for t in tenants]))
+
+    # encoders are only used on the sender thread
+    encoder = ReportEncoder()
+    transport = HttpTransport(options)
+
+    def send(reports):
+        # reports sharing the same auth go out as one batch
+        batches = {}
+        for auth, e, stat_data in reports:
+            batches.setdefault(auth, []).append(e.json(stat_data))
+        try:
+            for (auth_mode, user, password), items in batches.items():
+                body = items[0] if len(items) == 1 else b"[" + b",".join(items) + b"]"
+                if options.debug:
+                    print(body.decode("utf-8"))
+                transport.post(body, HTTPBasicAuth(user, password),
+                               {"ssr-auth": auth_mode, "Content-Type": "application/json"})
+        except Exception:
+            for e in [encoder] + [t.encoder for t in tenants]:
+                e.reset()
+            raise
+        for _, e, _ in reports:
+            e.ack(transport.connects)
+
+    sender = LatestSender(send)
+    register_collector("transport", options.interval,
+                       lambda: dict(transport.stats(), superseded=sender.superseded))
+    for _ in fixed_rate(options.interval):
+        try:
+            host_data = sample(options, stat_base)
+            host_data['latest_ts'] = int(time.time())
+            reports = [((ssr_auth, auth_user, options.password), encoder, host_data)]
+            for t in tenants:
+                # one broken tenant must not hold back the host and the others
+                try:
+                    stat_data = t.sample(host_data)
+                except Exception as ex:
+                    traceback.print_exc()
+                    continue
+                if stat_data is not None:
+                    reports.append((t.auth, t.encoder, stat_data))
+            sender.submit(reports)
+        except KeyboardInterrupt:
+            raise
+        except Exception as ex:
+            traceback.print_exc()
+
+
+IP_API_URL = "http://ip-api.com/json?fields=status,message,continent,continentCode,country,countryCode,region,regionName,city,district,zip,lat,lon,timezone,isp,org,as,asname,query&lang=zh-CN"
+
+
+def get_ip_info():
+    """ip info"""
+    import requests
+    r = requests.get(IP_API_URL, timeout=5)
+    resp = r.json()
+    # print(json.dumps(resp, indent=2))
+    ip_info = {
+        "query": resp.get("query", "unknown"),
+        "source": "ip-api.com",
+        "continent": resp.get("continent", "unknown"),
+        "country": resp.get("country", "unknown"),
+        "region_name": resp.get("regionName", "unknown"),
+        "city": resp.get("city", "unknown"),
+        "isp": resp.get("isp", "unknown"),
+        "org": resp.get("org", "unknown"),
+        "as": resp.get("as", "unknown"),
+        "asname": resp.get("asname", "unknown"),
+        "lat": resp.get("lat", 0),
+        "lon": resp.get("lon", 0),
+        "timezone": resp.get("timezone", "Asia/Shanghai"),
+    }
+    # print(json.dumps(ip_info, indent=2))
+    return ip_info
 
 
 def get_sys_info(options):
@@ -461,6 +1999,47 @@ def get_sys_info(options):
     return sys_info
 
 
+CACHE_FILE = ".server_status_cache"
+G_CACHE = {}
+G_CACHE_LOCK = threading.Lock()
+
+
+def _cache_key():
+    import platform
+    return "{}/{}".format(int(psutil.boot_time()), platform.release())
+
+
+def load_cache():
+    """sys_info, ip_info, online4/6 saved by a previous run of this boot and kernel"""
+    try:
+        with open(CACHE_FILE, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("key") != _cache_key():
+        return {}
+    return cache
+
+
+def save_cache(**kwargs):
+    with G_CACHE_LOCK:
+        G_CACHE.update(kwargs)
+        G_CACHE["key"] = _cache_key()
+        try:
+            tmp = CACHE_FILE + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(G_CACHE, f)
+            os.replace(tmp, CACHE_FILE)
+        except OSError as ex:
+            print("save {} fail: {}".format(CACHE_FILE, ex))
+
+
+def refresh_ip_info():
+    ip_info = get_ip_info()
+    save_cache(ip_info=ip_info)
+    return ip_info
+
+
 def gen_sys_id(sys_info):
     """"""
     SYS_ID_FILE = ".server_status_sys_id"
@@ -487,14 +2066,29 @@ def gen_sys_id(sys_info):
     return sys_id
 
 
+class IfaceFilter:
+    """--iface/--exclude-iface decision, compiled once and cached per iface name"""
+
+    def __init__(self, iface, exclude_iface):
+        self.include = frozenset(iface)
+        self.exclude = tuple(exclude_iface)
+        self.cache = {}
+
+    def skip(self, name):
+        v = self.cache.get(name)
+        if v is None:
+            if self.include:
+                v = name not in self.include
+            else:
+                v = any(e in name for e in self.exclude)
+            if len(self.cache) > 4096:
+                self.cache.clear()
+            self.cache[name] = v
+        return v
+
+
 def skip_iface(name, options):
-    if len(options.iface) > 0:
-        if any([name == e for e in options.iface]):
-            return False
-        return True
-    if any([e in name for e in options.exclude_iface]):
-        return True
-    return False
+    return options.iface_filter.skip(name)
 
 
 def main():
@@ -502,6 +2096,7 @@ def main():
     eg:
         python3 %prog -a http://127.0.0.1:8080/report -u h1 -p p1
         python3 %prog -a http://127.0.0.1:8080/report -u h1 -p p1 -n
+        python3 %prog -a grpc://127.0.0.1:9394 -u h1 -p p1
     """
     parser = OptionParser(usage)
 
@@ -517,6 +2112,8 @@ def main():
                       default="p1", help="auth pass [default: %default]")
     parser.add_option("-n", "--vnstat", default=False,
                       action="store_true", help="enable vnstat [default: %default]")
+    parser.add_option("--vnstat-db", dest="vnstat_db", default=VNSTAT_DB_PATH,
+                      help="vnstat database, falls back to vnstat --json when missing [default: %default]")
     parser.add_option("--disable-extra", default=False,
                       action="store_true", help="disable extra info report [default: %default]")
     parser.add_option("--disable-ping", default=False,
@@ -529,6 +2126,29 @@ def main():
                       help="China Telecom probe addr [default: %default]")
     parser.add_option("--cu", dest="cu", default=CU,
                       help="China Unicom probe addr [default: %default]")
+    parser.add_option("--probe", dest="probe", default="",
+                      help="extra probe list, eg: hk=1.1.1.1:80,sg=example.com:443/5/2 (mark=host:port[/interval[/timeout]]) [default: %default]")
+    parser.add_option("--compress", dest="compress", default="none",
+                      help="http body encoding: none, gzip, zstd (pip3 install zstandard), needs server support [default: %default]")
+    parser.add_option("--cgroup", default=False,
+                      action="store_true", help="report cpu/memory of the container (cgroup v1/v2) the client runs in [default: %default]")
+    parser.add_option("--tenants", dest="tenants", default="",
+                      help="json file of containers to report from cgroup v2, "
+                           "eg: [{\"name\": \"ct1\", \"alias\": \"web\", \"cgroup\": \"lxc.payload.ct1\"}] [default: %default]")
+    parser.add_option("--bench", dest="bench", default=0,
+                      help="run the collectors N times without reporting and print their cost [default: %default]")
+    parser.add_option("--profile", dest="profile", default="",
+                      help="with --bench, save cProfile stats to file [default: %default]")
+    parser.add_option("--report-timings", default=False,
+                      action="store_true", help="report per-collector timings in custom [default: %default]")
+    parser.add_option("--metrics", dest="metrics", default="",
+                      help="serve prometheus/openmetrics on addr, eg: 127.0.0.1:9110, empty to disable [default: %default]")
+    parser.add_option("-d", "--debug", default=False,
+                      action="store_true", help="print every report [default: %default]")
+    parser.add_option("--mtls", default=False,
+                      action="store_true", help="enable grpc mTLS [default: %default]")
+    parser.add_option("--tls-dir", dest="tls_dir",
+                      default="tls", help="tls certs dir for mTLS [default: %default]")
     parser.add_option("-w", "--weight", dest="weight",
                       default=0, help="weight for rank [default: %default]")
     parser.add_option("--disable-notify", default=False,
@@ -544,6 +2164,12 @@ def main():
                       help="exclude iface [default: %default]")
     parser.add_option("--interval", dest="interval",
                       default=1, help="report interval [default: %default]")
+    parser.add_option("--hires", dest="hires", default=0,
+                      help="sample cpu/net at N Hz (10-100), report min/max/avg/p95 per interval in custom, 0 to disable [default: %default]")
+    parser.add_option("--tupd-interval", dest="tupd_interval",
+                      default=10, help="t/u/p/d refresh interval [default: %default]")
+    parser.add_option("--hdd-interval", dest="hdd_interval",
+                      default=30, help="disk usage refresh interval [default: %default]")
 
     (options, args) = parser.parse_args()
 
@@ -551,14 +2177,27 @@ def main():
         filter(lambda s: len(s), map(str.strip, ifaces.split(","))))
     options.iface = parse_iface_list(options.iface)
     options.exclude_iface = parse_iface_list(options.exclude_iface)
+    options.interval = float(options.interval)
+    options.hdd_interval = float(options.hdd_interval)
+    options.tupd_interval = float(options.tupd_interval)
+    options.bench = int(options.bench)
+    options.hires = float(options.hires)
+    if options.compress not in ("none", "gzip", "zstd"):
+        raise RuntimeError("unsupported: --compress {}".format(options.compress))
     print(json.dumps(options.__dict__, indent=2))
+    options.iface_filter = IfaceFilter(options.iface, options.exclude_iface)
 
     if options.vnstat:
         if sys.platform.startswith("win"):
             raise RuntimeError("unsupported: enable vnstat on win os")
 
-    # sys info
-    sys_info = get_sys_info(options)
+    # sys info, cpuinfo can take seconds, reuse the last one of this boot
+    G_CACHE.update(load_cache())
+    sys_info = G_CACHE.get("sys_info")
+    if sys_info is None:
+        sys_info = get_sys_info(options)
+        save_cache(sys_info=sys_info)
+    sys_info["name"] = options.username
     sys_id = gen_sys_id(sys_info)
     print("sys info: {}".format(json.dumps(sys_info, indent=2)))
     print("sys id: {}".format(sys_id))
@@ -595,10 +2234,22 @@ def main():
     print("stat_base: {}".format(json.dumps(stat_base, indent=2)))
     # sys.exit(0)
 
-    if options.addr.startswith("http"):
+    if options.bench > 0:
+        bench(options, stat_base)
+        return
+
+    if options.report_timings:
+        global G_TIMER
+        G_TIMER = CollectorTimer()
+
+    if len(options.tenants) > 0:
+        if not options.addr.startswith("http"):
+            raise RuntimeError("unsupported: --tenants needs a http addr")
+        tenants_report(options, stat_base)
+    elif options.addr.startswith("http"):
         http_report(options, stat_base)
     elif options.addr.startswith("grpc"):
-        raise RuntimeError("grpc unsupported")
+        grpc_report(options, stat_base)
     else:
         print("invalid addr scheme")
 
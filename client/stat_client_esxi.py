@@ -1,28 +1,36 @@
 '''
-因为esxi 默认就是20s刷新一次,所以暂时就只能写成这个样子了🤷‍♂️
-python3 -m pip install pyVmomi requests schedule
+esxi 默认 20s 刷新一次实时性能数据, 采集对齐到 20s 边界
+主机/存储属性由 PropertyCollector WaitForUpdatesEx 增量同步, 可用 vcsim 本地测试
+python3 -m pip install pyVmomi requests
 '''
 from pyVim.connect import SmartConnectNoSSL, Disconnect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 from datetime import timedelta
 import atexit
 from optparse import OptionParser
 from requests.auth import HTTPBasicAuth
 import requests
 import json
+import time
+import hashlib
+import threading
 import traceback
-import schedule
 import copy
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 esxi_host = None
+http_session = None
+worker_pool = None
+# hosts per QueryPerf in cluster mode
+QUERY_CHUNK = 50
 
 class EsxiHost:
+    """vSphere session, content/perf counters/host view are cached until reconnect"""
     _si = None
     _username: str = None
     _password: str = None
     _vc_ip: str = None
     _vc_port: str = None
-    _perf_dict: dict = {}
 
     def __init__(self, username: str, password: str, vc_ip: str,
                  vc_port: str) -> None:
@@ -30,14 +38,28 @@ class EsxiHost:
         self._password = password
         self._vc_ip = vc_ip
         self._vc_port = vc_port
+        self._reset()
+        atexit.register(self._disconnect)
+
+    def _reset(self):
+        self._content = None
+        self._perf_dict = None
+        self._host_view = None
+        mirror, self._mirror = getattr(self, "_mirror", None), None
+        if mirror is not None:
+            mirror.stop()
+
+    def _disconnect(self):
+        if self._si is not None:
+            Disconnect(self._si)
 
     def _connect_to_server(self):
+        self._reset()
         try:
             self._si = SmartConnectNoSSL(host=self._vc_ip,
                                          user=self._username,
                                          pwd=self._password,
                                          port=self._vc_port)
-            atexit.register(Disconnect, self._si)
             return self._si
         except Exception as e:
             print(e)
@@ -54,7 +76,9 @@ class EsxiHost:
 
     @_si_check_wrapper
     def get_content(self):
-        return self._si.RetrieveContent()
+        if self._content is None:
+            self._content = self._si.RetrieveContent()
+        return self._content
 
     @_si_check_wrapper
     def get_esxi_time(self):
@@ -62,25 +86,40 @@ class EsxiHost:
 
     @_si_check_wrapper
     def get_retrieve_content(self):
-        return self._si.RetrieveContent()
+        return self.get_content()
 
     @_si_check_wrapper
     def get_perf_dict(self) -> dict:
-        self._perf_dict.clear()
-        content = self.get_retrieve_content()
-        perf_list = content.perfManager.perfCounter
-        for counter in perf_list:
-            counter_full = "{}.{}.{}".format(counter.groupInfo.key,
-                                             counter.nameInfo.key,
-                                             counter.rollupType)
-            self._perf_dict[counter_full] = counter.key
+        # the counter catalogue is several hundred objects, fetched once per session
+        if self._perf_dict is None:
+            perf_dict = {}
+            for counter in self.get_content().perfManager.perfCounter:
+                counter_full = "{}.{}.{}".format(counter.groupInfo.key,
+                                                 counter.nameInfo.key,
+                                                 counter.rollupType)
+                perf_dict[counter_full] = counter.key
+            self._perf_dict = perf_dict
         return self._perf_dict
 
     @_si_check_wrapper
     def get_esxi_host_obj(self):
-        content = self.get_retrieve_content()
-        return content.viewManager.CreateContainerView(content.rootFolder,
-                                                       [vim.HostSystem], True)
+        if self._host_view is None:
+            content = self.get_content()
+            self._host_view = content.viewManager.CreateContainerView(
+                content.rootFolder, [vim.HostSystem], True)
+        return self._host_view
+
+    @_si_check_wrapper
+    def get_mirror(self):
+        if self._mirror is None or self._mirror.failed:
+            if self._mirror is not None:
+                # destroy the server side collector of the dead mirror before replacing it
+                self._mirror.stop()
+                self._mirror = None
+            mirror = PropertyMirror(self.get_content(), self.get_esxi_host_obj())
+            mirror.start()
+            self._mirror = mirror
+        return self._mirror
 
     def is_alive(self) -> bool:
         if self._si is None:
@@ -93,74 +132,199 @@ class EsxiHost:
         return True
 
 
+class PropertyMirror:
+    """local copy of host/datastore properties, kept current by WaitForUpdatesEx
+
+    one long-poll per change set instead of a SOAP call per property and cycle
+    """
+    host_props = ["name", "summary.quickStats", "hardware.memorySize", "datastore"]
+    datastore_props = ["summary.capacity", "summary.freeSpace"]
+    max_wait_seconds = 30
+
+    def __init__(self, content, host_view) -> None:
+        self.content = content
+        self.host_view = host_view
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.version = ""
+        self.collector = None
+        self.stopped = False
+        self.failed = False
+
+    def start(self):
+        # own collector, its filter goes away with it
+        self.collector = self.content.propertyCollector.CreatePropertyCollector()
+        PC = vmodl.query.PropertyCollector
+        to_datastore = PC.TraversalSpec(type=vim.HostSystem, path="datastore", skip=False)
+        to_hosts = PC.TraversalSpec(type=vim.view.ContainerView, path="view", skip=False,
+                                    selectSet=[to_datastore])
+        spec = PC.FilterSpec(
+            objectSet=[PC.ObjectSpec(obj=self.host_view, skip=True, selectSet=[to_hosts])],
+            propSet=[PC.PropertySpec(type=vim.HostSystem, pathSet=self.host_props),
+                     PC.PropertySpec(type=vim.Datastore, pathSet=self.datastore_props)])
+        # whole values under the requested paths, not nested sub-property changes
+        self.collector.CreateFilter(spec, partialUpdates=False)
+        # the first call returns everything, the first report does not wait for the thread
+        self.poll(0)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self.collector.CancelWaitForUpdates()
+            self.collector.Destroy()
+        except Exception:
+            pass
+
+    def poll(self, max_wait):
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait)
+        while True:
+            update = self.collector.WaitForUpdatesEx(self.version, options)
+            if update is None:
+                return
+            self.apply(update)
+            self.version = update.version
+            # more changes are queued behind a truncated set
+            if not update.truncated:
+                return
+
+    def apply(self, update):
+        with self.lock:
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    key = obj_update.obj._moId
+                    if obj_update.kind == "leave":
+                        self.objects.pop(key, None)
+                        continue
+                    o = self.objects.setdefault(key, {"obj": obj_update.obj})
+                    for change in obj_update.changeSet:
+                        if change.op in ("remove", "indirectRemove"):
+                            o.pop(change.name, None)
+                        else:
+                            o[change.name] = change.val
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.poll(self.max_wait_seconds)
+            except Exception as e:
+                if not self.stopped:
+                    print(e)
+                    # rebuilt by the next cycle
+                    self.failed = True
+                return
+
+    def get(self, key) -> dict:
+        with self.lock:
+            return dict(self.objects.get(key, {}))
+
+    def hosts(self) -> list:
+        with self.lock:
+            return [o["obj"] for o in self.objects.values() if isinstance(o["obj"], vim.HostSystem)]
+
+
 class EsxiHostUtils:
     # https://communities.vmware.com/t5/Storage-Performance/vCenter-Performance-Counters/ta-p/2790328
     statistics_interval_time: int = 20  # 因为esxi默认就是20s刷新一次，所以这个间隔是一定不会报错的
-
-    def __init__(self, content, vc_time, perf_dict, host_obj) -> None:
+    # counter => instance, all fetched by one QueryPerf, "*" sums the instances if there is no aggregate
+    counters: dict = {
+        "cpu.usage.average": "",
+        "net.received.average": "",
+        "net.transmitted.average": "",
+        "disk.maxTotalLatency.latest": "",
+        "datastore.read.average": "*",
+        "datastore.write.average": "*",
+    }
+
+    def __init__(self, content, vc_time, perf_dict, host_obj, values=None) -> None:
         self.content = content
         self.vc_time = vc_time
         self.perf_dict = perf_dict
         self.host = host_obj
+        self.values = values
 
     def get_type_id(self, query_type):
         counter_id = self.perf_dict[query_type]
         return counter_id
 
+    def get_values(self, query_type) -> list:
+        if self.values is None:
+            self.values = self.query([self.host]).get(self.host._moId, {})
+        return self.values.get(query_type, [])
+
     def get_network_tx(self):
-        stat_network_tx = self.build_query(
-            query_type="net.transmitted.average")
         network_tx =  int(round(
-            sum(stat_network_tx[0].value[0].value) /
+            sum(self.get_values("net.transmitted.average")) /
             self.statistics_interval_time,2)) * 1024
         return network_tx * 1024
 
     def get_network_rx(self):
-        stat_network_rx = self.build_query(query_type="net.received.average")
         network_rx = int(round(
-            sum(stat_network_rx[0].value[0].value) /
+            sum(self.get_values("net.received.average")) /
             self.statistics_interval_time,2)) * 1024
 
         return network_rx * 1024
 
     def get_cpu_usage(self):
-        state_cpu_usage = self.build_query(query_type="cpu.usage.average")
         cpu_usage = float(
-            round((((sum(state_cpu_usage[0].value[0].value))) / 100 /
+            round((((sum(self.get_values("cpu.usage.average")))) / 100 /
                    self.statistics_interval_time), 1))
         return cpu_usage
 
-    def get_disk_capacity_and_usage(self, content) -> tuple:
-        capacity = 0
-        free_size = 0
-        for datacenter in content.rootFolder.childEntity:
-            datastores = datacenter.datastore
-            for ds in datastores:
-                capacity += ds.summary.capacity
-                free_size += ds.summary.freeSpace
-
-        capacity = int(round(capacity / 1024.0 / 1024.0, 0))
-        freesize = int(round(free_size / 1024.0 / 1024.0, 0))
-        return (capacity, freesize)
-
-    def build_query(self, query_type: str):
-        counter_id = self.get_type_id(query_type)
-        metric_id = vim.PerformanceManager.MetricId(counterId=counter_id,
-                                                    instance="")
+    def get_extra(self) -> dict:
+        """disk latency (ms) and datastore io (KBps) of the window"""
+        def last(query_type):
+            values = self.get_values(query_type)
+            return values[-1] if values else 0
+        return {
+            "disk_latency": last("disk.maxTotalLatency.latest"),
+            "datastore_read": last("datastore.read.average"),
+            "datastore_write": last("datastore.write.average"),
+        }
+
+    def query(self, entities) -> dict:
+        """one QueryPerf round trip for all counters and entities
+
+        returns {entity moId: {counter: [values]}}
+        """
+        names = {}
+        metric_ids = []
+        for query_type, instance in self.counters.items():
+            # not every host/version has every counter
+            if query_type not in self.perf_dict:
+                continue
+            counter_id = self.get_type_id(query_type)
+            names[counter_id] = query_type
+            metric_ids.append(vim.PerformanceManager.MetricId(counterId=counter_id,
+                                                              instance=instance))
         start_time = self.vc_time - timedelta(
             seconds=(self.statistics_interval_time))
-        # end_time = vc_time - timedelta(seconds=0)
         end_time = self.vc_time
-        query = vim.PerformanceManager.QuerySpec(intervalId=20,
-                                                 entity=self.host,
-                                                 metricId=[metric_id],
-                                                 startTime=start_time,
-                                                 endTime=end_time)
-        perf_results = self.content.perfManager.QueryPerf(querySpec=[query])
-        if perf_results:
-            return perf_results
-        else:
-            pass
+        specs = [vim.PerformanceManager.QuerySpec(intervalId=20,
+                                                  entity=entity,
+                                                  metricId=metric_ids,
+                                                  startTime=start_time,
+                                                  endTime=end_time)
+                 for entity in entities]
+        result = {}
+        for entity_metric in self.content.perfManager.QueryPerf(querySpec=specs) or []:
+            aggregate, instances = {}, {}
+            for series in entity_metric.value:
+                query_type = names.get(series.id.counterId)
+                if query_type is None:
+                    continue
+                if series.id.instance == "":
+                    aggregate[query_type] = list(series.value)
+                else:
+                    values = instances.setdefault(query_type, [])
+                    for i, v in enumerate(series.value):
+                        if i < len(values):
+                            values[i] += v
+                        else:
+                            values.append(v)
+            instances.update(aggregate)
+            result[entity_metric.entity._moId] = instances
+        return result
 
 
 PostData = {
@@ -258,53 +422,138 @@ PostData = {
 #         return getattr(self, item)
 
 
-def gather_data(username: str, password: str, vc_ip: str, vc_port: str,
-                host_username: str) -> dict:
+def gather_host(esxi_utils, mirror, host, post_data) -> dict:
+    props = mirror.get(host._moId)
+    stats = props["summary.quickStats"]
+    post_data["uptime"] = stats.uptime
+    post_data["memory_total"] = int(round(props["hardware.memorySize"] / 1024, 0))
+    post_data["memory_used"] = stats.overallMemoryUsage * 1024
+    capacity, free_size = 0, 0
+    for ds in props.get("datastore", []):
+        ds_props = mirror.get(ds._moId)
+        capacity += ds_props.get("summary.capacity", 0)
+        free_size += ds_props.get("summary.freeSpace", 0)
+    post_data["hdd_total"] = int(round(capacity / 1024.0 / 1024.0, 0))
+    post_data["hdd_used"] = post_data["hdd_total"] - int(round(free_size / 1024.0 / 1024.0, 0))
+    post_data["cpu"] = esxi_utils.get_cpu_usage()
+    post_data["network_rx"] = esxi_utils.get_network_rx()
+    post_data["network_tx"] = esxi_utils.get_network_tx()
+    post_data["custom"] = json.dumps(esxi_utils.get_extra(), separators=(",", ":"))
+    return post_data
 
+
+def connect(username: str, password: str, vc_ip: str, vc_port: str):
     global esxi_host
     if esxi_host is None:
         esxi_host = EsxiHost(username, password, vc_ip, vc_port)
 
+    # the session may have expired, a reconnect drops the cached objects
+    if not esxi_host.is_alive():
+        esxi_host._connect_to_server()
+    return esxi_host
+
+
+def gather_data(username: str, password: str, vc_ip: str, vc_port: str,
+                host_username: str) -> dict:
+    esxi_host = connect(username, password, vc_ip, vc_port)
+
     post_data = copy.deepcopy(PostData)
-    host_view = esxi_host.get_esxi_host_obj()
-    if len(host_view.view) > 1:
-        raise "暂时不支持集群或vcenter"
-    # for host in host_view.view:
-    host = host_view.view[0]
-    stats = host.summary.quickStats
-    hardware = host.hardware
+    mirror = esxi_host.get_mirror()
+    hosts = mirror.hosts()
+    if len(hosts) > 1:
+        raise RuntimeError("多台主机, 请使用 --cluster")
+    host = hosts[0]
     post_data["name"] = host_username
-    post_data["uptime"] = stats.uptime
-    post_data["memory_total"] = int(round(hardware.memorySize / 1024, 0))
-    post_data["memory_used"] = stats.overallMemoryUsage * 1024
     esxi_utils = EsxiHostUtils(content=esxi_host.get_content(),
                                vc_time=esxi_host.get_esxi_time(),
                                perf_dict=esxi_host.get_perf_dict(),
                                host_obj=host)
-    volume_capacity, volume_free_sapce = esxi_utils.get_disk_capacity_and_usage(
-        content=esxi_host.get_content())
-    volume_used_space = volume_capacity - volume_free_sapce
-    post_data["hdd_total"] = volume_capacity
-    post_data["hdd_used"] = volume_used_space
-    post_data["cpu"] = esxi_utils.get_cpu_usage()
-    post_data["network_rx"] = esxi_utils.get_network_rx()
-    post_data["network_tx"] = esxi_utils.get_network_tx()
-    return post_data
+    return gather_host(esxi_utils, mirror, host, post_data)
+
+
+def gather_cluster(options) -> list:
+    """every HostSystem behind one vCenter login, one report per host"""
+    esxi_host = connect(options.esxi_username, options.esxi_password,
+                        options.esxi_addr, options.esxi_port)
+    mirror = esxi_host.get_mirror()
+    hosts = mirror.hosts()
+    content = esxi_host.get_content()
+    vc_time = esxi_host.get_esxi_time()
+    perf_dict = esxi_host.get_perf_dict()
+
+    # perf counters of QUERY_CHUNK hosts per QueryPerf, chunks run concurrently
+    query_utils = EsxiHostUtils(content, vc_time, perf_dict, None)
+    chunks = [hosts[i:i + QUERY_CHUNK] for i in range(0, len(hosts), QUERY_CHUNK)]
+    values = {}
+    for result in worker_pool.map(query_utils.query, chunks):
+        values.update(result)
+
+    # properties come from the mirror, no round trips from here on
+    data = []
+    for host in hosts:
+        try:
+            post_data = copy.deepcopy(PostData)
+            # stable per vCenter, alias is what the dashboard shows
+            post_data["name"] = hashlib.md5("{}/{}".format(
+                options.esxi_addr, host._moId).encode("utf-8")).hexdigest()
+            post_data["gid"] = options.gid
+            post_data["alias"] = mirror.get(host._moId).get("name", host._moId)
+            esxi_utils = EsxiHostUtils(content, vc_time, perf_dict, host,
+                                       values=values.get(host._moId, {}))
+            data.append(gather_host(esxi_utils, mirror, host, post_data))
+        except Exception as e:
+            traceback.print_exc()
+    return data
 
 
-def report(username: str, password: str, addr: str, data):
+def report(username: str, password: str, addr: str, data, ssr_auth="single"):
+    """data: one report, or a list sent as one batch"""
+    global http_session
+    if http_session is None:
+        # keep-alive across reports
+        http_session = requests.Session()
     try:
-        sess = requests.Session()
-        ssr_auth = "single"
         http_headers = {"ssr-auth": ssr_auth}
         auth = HTTPBasicAuth(username, password)
-        r = sess.post(addr, auth=auth, json=data, headers=http_headers)
+        r = http_session.post(addr, auth=auth, json=data, headers=http_headers, timeout=10)
         print(r)
     except Exception as e:
         print(e)
         traceback.print_exc()
 
 
+def poll(options, job):
+    """run job every interval on a worker thread, aligned to the esxi stats window
+
+    sleeps until the next deadline, a run still going at the next tick is not
+    started again, a run longer than --timeout is reported and left to finish
+    """
+    interval = options.interval
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = None
+    # realtime samples of a window are published shortly after its end
+    next_ts = (time.time() // interval + 1) * interval + options.offset
+    while True:
+        delay = next_ts - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # fell behind, skip the missed windows
+            next_ts += (-delay // interval) * interval
+        next_ts += interval
+
+        if future is not None and not future.done():
+            print("previous run still in progress, skip")
+            continue
+        future = executor.submit(job, options)
+        try:
+            future.result(timeout=options.timeout)
+        except TimeoutError:
+            print("run timeout after {}s".format(options.timeout))
+        except Exception as e:
+            traceback.print_exc()
+
+
 def run(options):
     s_addr = options.addr
     s_username = options.username
@@ -315,6 +564,11 @@ def run(options):
     esxi_password = options.esxi_password
     esxi_addr = options.esxi_addr
     esxi_port = options.esxi_port
+    if options.cluster:
+        data = gather_cluster(options)
+        print("{} hosts".format(len(data)))
+        report(s_gid, s_password, s_addr, data, "group")
+        return
     data = gather_data(esxi_username, esxi_password, esxi_addr, esxi_port,
                        s_username)
     report(s_username, s_password, s_addr, data)
@@ -325,6 +579,7 @@ if __name__ == "__main__":
     usage = """usage: python3 %prog [options] arg
     eg:
         python3 %prog -a http://127.0.0.1:8080/report -u h1 -p p1 --esxiuser root --esxipasswd password --esxiaddr 192.169.1.2 --esxiport 443
+        python3 %prog -a http://127.0.0.1:8080/report -g g1 -p pp --cluster --esxiuser administrator@vsphere.local --esxipasswd password --esxiaddr 192.169.1.3
     """
     parser = OptionParser(usage)
 
@@ -372,14 +627,36 @@ if __name__ == "__main__":
                       dest="esxi_port",
                       default="443",
                       help="esxi port [default: %default]")
+    parser.add_option("--interval",
+                      dest="interval",
+                      default=EsxiHostUtils.statistics_interval_time,
+                      help="report interval, multiple of the 20s esxi stats interval [default: %default]")
+    parser.add_option("--offset",
+                      dest="offset",
+                      default=2,
+                      help="seconds after the stats window ends [default: %default]")
+    parser.add_option("--timeout",
+                      dest="timeout",
+                      default=15,
+                      help="max seconds to wait for one run [default: %default]")
+    parser.add_option("--cluster",
+                      default=False,
+                      action="store_true",
+                      help="vCenter/cluster, report every host under --gid [default: %default]")
+    parser.add_option("--workers",
+                      dest="workers",
+                      default=16,
+                      help="max concurrent vCenter calls in cluster mode [default: %default]")
     (options, args) = parser.parse_args()
+    if options.cluster and len(options.gid) == 0:
+        parser.error("--cluster needs --gid")
+    worker_pool = ThreadPoolExecutor(max_workers=int(options.workers))
+    options.interval = float(options.interval)
+    options.offset = float(options.offset)
+    options.timeout = float(options.timeout)
     print(json.dumps(options.__dict__, indent=2))
-    schedule.every(5).seconds.do(run, options)
-    print("running... report every 5 seconds")
-    while True:
-        try:
-            
-            schedule.run_pending()
-            # run(options)
-        except KeyboardInterrupt:
-            exit(0)
\ No newline at end of file
+    print("running... report every {} seconds".format(options.interval))
+    try:
+        poll(options, run)
+    except KeyboardInterrupt:
+        exit(0)
\ No newline at end of file
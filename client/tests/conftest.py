@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the clients are single scripts, not a package: client/*.py and the legacy client.py at the top
+CLIENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(CLIENT_DIR))
+sys.path.insert(0, CLIENT_DIR)
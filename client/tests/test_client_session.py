@@ -0,0 +1,118 @@
+"""client.py Session against a stand-in line protocol server"""
+import socket
+import threading
+import time
+
+import client
+
+
+class StandInServer:
+    """accepts one connection, optionally asks for auth, collects the lines sent"""
+
+    def __init__(self, auth):
+        self.auth = auth
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.credentials = None
+        self.lines = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        conn, _ = self.sock.accept()
+        f = conn.makefile("rb")
+        if self.auth:
+            conn.sendall(b"Authentication required\n")
+            self.credentials = f.readline().strip()
+            conn.sendall(b"Authentication successful\n")
+        else:
+            conn.sendall(b"You are connecting via: IPv4\n")
+        for line in f:
+            self.lines.append(line)
+
+    def close(self):
+        self.sock.close()
+
+
+def run_until_received(session, server, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not server.lines and time.monotonic() < deadline:
+        session.run_until(time.monotonic() + 0.05)
+
+
+def test_auth_handshake():
+    server = StandInServer(auth=True)
+    session = client.Session("127.0.0.1", server.port, "u1", "secret")
+    session.failures = 3
+    session.send(b"update {}\n")
+    run_until_received(session, server)
+    assert server.credentials == b"u1:secret"
+    assert server.lines == [b"update {}\n"]
+    assert session.state == "ready"
+    assert session.failures == 0
+    server.close()
+
+
+def test_ready_without_auth_resets_failures():
+    server = StandInServer(auth=False)
+    session = client.Session("127.0.0.1", server.port, "u1", "secret")
+    session.failures = 3
+    session.send(b"update {}\n")
+    run_until_received(session, server)
+    assert server.lines == [b"update {}\n"]
+    assert session.failures == 0
+    server.close()
+
+
+def test_refused_connection_backs_off():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    session = client.Session("127.0.0.1", port, "u1", "secret")
+    session.run_until(time.monotonic() + 0.2)
+    assert session.sock is None
+    assert session.failures >= 1
+    assert session.retry_ts > time.monotonic()
+
+
+def test_slow_resolver_does_not_stall_the_loop(monkeypatch):
+    server = StandInServer(auth=False)
+    getaddrinfo = socket.getaddrinfo
+
+    def slow_getaddrinfo(*args):
+        time.sleep(0.5)
+        return getaddrinfo(*args)
+
+    monkeypatch.setattr(client.socket, "getaddrinfo", slow_getaddrinfo)
+    session = client.Session("127.0.0.1", server.port, "u1", "secret")
+    session.send(b"update {}\n")
+    b = time.monotonic()
+    session.run_until(b + 0.1)
+    assert time.monotonic() - b < 0.2
+    assert session.sock is None and session.resolving is not None
+    run_until_received(session, server)
+    assert server.lines == [b"update {}\n"]
+    server.close()
+
+
+def test_failed_resolve_uses_the_last_address(monkeypatch):
+    server = StandInServer(auth=False)
+    session = client.Session("127.0.0.1", server.port, "u1", "secret")
+    session.addr = socket.getaddrinfo("127.0.0.1", server.port, 0, socket.SOCK_STREAM)[0]
+
+    def failing_getaddrinfo(*args):
+        raise socket.gaierror("Temporary failure in name resolution")
+
+    monkeypatch.setattr(client.socket, "getaddrinfo", failing_getaddrinfo)
+    session.send(b"update {}\n")
+    run_until_received(session, server)
+    assert server.lines == [b"update {}\n"]
+    assert session.failures == 0
+    server.close()
+
+
+def test_backoff_delay():
+    for failures, low, high in ((0, 0.5, 1.0), (3, 4.0, 8.0), (10, 30.0, 60.0)):
+        assert low <= client.backoff_delay(failures) <= high
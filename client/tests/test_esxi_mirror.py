@@ -0,0 +1,112 @@
+"""PropertyMirror update handling
+
+the vcsim smoke test runs against a local simulator:
+    vcsim -l 127.0.0.1:8989 &
+    SSR_VCSIM=127.0.0.1:8989 python3 -m pytest tests/test_esxi_mirror.py
+"""
+import os
+import pytest
+
+pytest.importorskip("pyVmomi")
+
+from pyVmomi import vim, vmodl
+import stat_client_esxi
+
+PC = vmodl.query.PropertyCollector
+
+
+def update_set(*obj_updates, version="1"):
+    return PC.UpdateSet(version=version, truncated=False,
+                        filterSet=[PC.FilterUpdate(objectSet=list(obj_updates))])
+
+
+def obj_update(kind, obj, **changes):
+    change_set = []
+    for name, val in changes.items():
+        name = name.replace("__", ".")
+        if val is None:
+            change_set.append(PC.Change(name=name, op="remove"))
+        else:
+            change_set.append(PC.Change(name=name, op="assign", val=val))
+    return PC.ObjectUpdate(kind=kind, obj=obj, changeSet=change_set)
+
+
+def new_mirror():
+    return stat_client_esxi.PropertyMirror(content=None, host_view=None)
+
+
+def test_enter_modify_leave():
+    mirror = new_mirror()
+    host = vim.HostSystem("host-1")
+    datastore = vim.Datastore("datastore-1")
+
+    mirror.apply(update_set(
+        obj_update("enter", host, name="esx1", hardware__memorySize=1024),
+        obj_update("enter", datastore, summary__capacity=100, summary__freeSpace=40)))
+    assert mirror.hosts() == [host]
+    assert mirror.get("host-1") == {"obj": host, "name": "esx1", "hardware.memorySize": 1024}
+    assert mirror.get("datastore-1")["summary.freeSpace"] == 40
+
+    # only the changed properties come back, the others are kept
+    mirror.apply(update_set(obj_update("modify", datastore, summary__freeSpace=30), version="2"))
+    assert mirror.get("datastore-1")["summary.freeSpace"] == 30
+    assert mirror.get("datastore-1")["summary.capacity"] == 100
+
+    mirror.apply(update_set(obj_update("modify", host, hardware__memorySize=None), version="3"))
+    assert "hardware.memorySize" not in mirror.get("host-1")
+    assert mirror.get("host-1")["name"] == "esx1"
+
+    mirror.apply(update_set(obj_update("leave", host), version="4"))
+    assert mirror.hosts() == []
+    assert mirror.get("host-1") == {}
+    assert mirror.get("datastore-1")["summary.freeSpace"] == 30
+
+
+def test_failed_mirror_is_stopped_before_rebuild(monkeypatch):
+    class FakeMirror:
+        def __init__(self, content, host_view):
+            self.failed = False
+            self.stopped = False
+
+        def start(self):
+            pass
+
+        def stop(self):
+            self.stopped = True
+
+    monkeypatch.setattr(stat_client_esxi, "PropertyMirror", FakeMirror)
+    esxi_host = stat_client_esxi.EsxiHost("user", "pass", "127.0.0.1", "443")
+    esxi_host._si = object()
+    esxi_host._content = object()
+    esxi_host._host_view = object()
+
+    first = esxi_host.get_mirror()
+    assert esxi_host.get_mirror() is first
+    first.failed = True
+    second = esxi_host.get_mirror()
+    assert second is not first
+    assert first.stopped and not second.stopped
+    esxi_host._si = None
+
+
+@pytest.mark.skipif(not os.environ.get("SSR_VCSIM"), reason="SSR_VCSIM=host:port of a vcsim not set")
+def test_vcsim_smoke():
+    addr, port = os.environ["SSR_VCSIM"].rsplit(":", 1)
+    esxi_host = stat_client_esxi.EsxiHost("user", "pass", addr, port)
+    mirror = esxi_host.get_mirror()
+    try:
+        hosts = mirror.hosts()
+        assert hosts
+        for host in hosts:
+            props = mirror.get(host._moId)
+            assert props["name"]
+            assert props["hardware.memorySize"] > 0
+            for datastore in props["datastore"]:
+                assert mirror.get(datastore._moId)["summary.capacity"] > 0
+        # the long poll thread is still waiting for changes
+        assert not mirror.failed
+    finally:
+        esxi_host._reset()
+        esxi_host._disconnect()
+        esxi_host._si = None
+    assert mirror.stopped
@@ -0,0 +1,160 @@
+"""grpc_report against an in-process grpc server
+
+the server parses the requests with StatRequest compiled from
+common/proto/server_status.proto, so pb_encode is checked against the real schema
+"""
+import os
+import sys
+import time
+import types
+from concurrent import futures
+
+import pytest
+
+grpc = pytest.importorskip("grpc")
+protoc = pytest.importorskip("grpc_tools.protoc")
+
+import stat_client
+
+PROTO_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                         "common", "proto")
+
+
+@pytest.fixture(scope="module")
+def pb(tmp_path_factory):
+    out = str(tmp_path_factory.mktemp("pb"))
+    assert protoc.main(["protoc", "-I" + PROTO_DIR, "--python_out=" + out,
+                        os.path.join(PROTO_DIR, "server_status.proto")]) == 0
+    sys.path.insert(0, out)
+    try:
+        import server_status_pb2
+    finally:
+        sys.path.remove(out)
+    return server_status_pb2
+
+
+@pytest.fixture
+def server(pb):
+    o = types.SimpleNamespace(requests=[], delay=0, port=0)
+
+    def report(request, context):
+        o.requests.append((pb.StatRequest.FromString(request), dict(context.invocation_metadata())))
+        time.sleep(o.delay)
+        return pb.Response(code=-3, message="ok ✓").SerializeToString()
+
+    def start():
+        o.srv = grpc.server(futures.ThreadPoolExecutor(2))
+        o.srv.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(
+            "server_status.ServerStatus", {"Report": grpc.unary_unary_rpc_method_handler(report)}),))
+        o.port = o.srv.add_insecure_port("127.0.0.1:{}".format(o.port))
+        o.srv.start()
+
+    def restart():
+        o.srv.stop(None)
+        start()
+
+    start()
+    o.restart = restart
+    o.options = types.SimpleNamespace(addr="grpc://127.0.0.1:{}".format(o.port), mtls=False,
+                                      password="p1", interval=1, debug=False)
+    channel = stat_client.grpc_channel(o.options)
+    o.report = channel.unary_unary("/server_status.ServerStatus/Report")
+    yield o
+    channel.close()
+    o.srv.stop(None)
+
+
+STAT = {
+    "name": "h1", "frame": "data", "cpu": 12.5, "network_rx": 0, "tcp": 4, "uptime": 123,
+    "weight": "7", "notify": True, "online6": False, "custom": "",
+    "network_in": 2 ** 50, "latest_ts": 1700000000,
+    "sys_info": {"name": "h1", "cpu_num": 8, "cpu_brand": "x"},
+    "ip_info": {"query": "1.2.3.4", "lat": 1.5},
+    "disks": [{"name": "/dev/a", "total": 2 ** 40, "used": 5}, {"name": "/dev/b", "total": 3}],
+}
+
+
+def test_encode_matches_proto(server):
+    resp = server.report(bytes(stat_client.pb_encode(STAT)), timeout=3)
+    assert stat_client.pb_decode_response(resp) == (-3, "ok ✓")
+
+    req = server.requests[0][0]
+    assert (req.name, req.frame, req.cpu, req.tcp, req.uptime) == ("h1", "data", 12.5, 4, 123)
+    assert (req.weight, req.notify, req.online6) == (7, True, False)
+    assert (req.network_in, req.latest_ts) == (2 ** 50, 1700000000)
+    assert req.HasField("custom") and req.custom == ""
+    assert (req.sys_info.name, req.sys_info.cpu_num, req.sys_info.cpu_brand) == ("h1", 8, "x")
+    assert (req.ip_info.query, req.ip_info.lat) == ("1.2.3.4", 1.5)
+    assert [(d.name, d.total, d.used) for d in req.disks] == [("/dev/a", 2 ** 40, 5), ("/dev/b", 3, 0)]
+
+
+def test_every_field_round_trips(pb):
+    values = {"string": "s", "uint": 3, "double": 0.5, "bool": True}
+
+    def fill(fields):
+        return {k: fill(kind) if isinstance(kind, tuple) else values[kind] for k, _, kind in fields}
+
+    data = fill(stat_client.PB_STAT_REQUEST)
+    req = pb.StatRequest.FromString(bytes(stat_client.pb_encode(data)))
+    for key, _, kind in stat_client.PB_STAT_REQUEST:
+        v = getattr(req, key)
+        if key == "disks":
+            v = v[0]
+        if isinstance(kind, tuple):
+            for sub_key, _, sub_kind in kind:
+                assert getattr(v, sub_key) == values[sub_kind], (key, sub_key)
+        else:
+            assert v == values[kind], key
+
+
+def test_sampling_does_not_wait_on_the_rpc(server, monkeypatch):
+    monkeypatch.setattr(stat_client, "init_report", lambda options, stat_base: ("single", "h1"))
+    monkeypatch.setattr(stat_client, "register_collector", lambda *args, **kwargs: None)
+
+    def fixed_rate(interval):
+        for i in range(3):
+            yield i
+            time.sleep(0.1)
+
+    monkeypatch.setattr(stat_client, "fixed_rate", fixed_rate)
+    ticks = iter(range(3))
+    monkeypatch.setattr(stat_client, "sample",
+                        lambda options, stat_base: dict(STAT, uptime=next(ticks)))
+    server.delay = 0.5
+
+    b = time.monotonic()
+    stat_client.grpc_report(server.options, {})
+    # 3 ticks 0.1s apart, the rpcs take 0.5s each
+    assert time.monotonic() - b < 0.5
+
+    deadline = time.monotonic() + 3
+    while len(server.requests) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # the second tick is superseded by the third while the first is in flight
+    assert [req.uptime for req, _ in server.requests] == [0, 2]
+    md = server.requests[0][1]
+    assert md["authorization"] == "h1@_@p1" and md["ssr-auth"] == "single"
+    # acked static fields are not sent again
+    assert server.requests[0][0].HasField("sys_info")
+    assert not server.requests[1][0].HasField("sys_info")
+
+
+def test_static_fields_resent_after_server_restart(server, monkeypatch):
+    monkeypatch.setattr(stat_client, "init_report", lambda options, stat_base: ("single", "h1"))
+    monkeypatch.setattr(stat_client, "register_collector", lambda *args, **kwargs: None)
+    monkeypatch.setattr(stat_client, "sample", lambda options, stat_base: dict(STAT))
+
+    def fixed_rate(interval):
+        for i in range(6):
+            yield i
+            deadline = time.monotonic() + 5
+            while len(server.requests) <= i and time.monotonic() < deadline:
+                time.sleep(0.02)
+            if i == 2:
+                server.restart()
+
+    monkeypatch.setattr(stat_client, "fixed_rate", fixed_rate)
+    stat_client.grpc_report(server.options, {})
+
+    # 0-2 first server, 3-5 restarted one; 3 went out stripped on the new connection
+    assert [req.HasField("sys_info") for req, _ in server.requests] == [True, False, False, False, True, False]
@@ -0,0 +1,22 @@
+"""disk enumeration"""
+import collections
+
+import stat_client
+
+Partition = collections.namedtuple("Partition", "device mountpoint fstype opts")
+
+
+def test_zfs_pool_counted_once(monkeypatch):
+    monkeypatch.setattr(stat_client.psutil, "disk_partitions", lambda: [
+        Partition("/dev/sda1", "/boot", "ext4", "rw"),
+        Partition("rpool/ROOT/debian", "/", "zfs", "rw"),
+        Partition("rpool/home", "/home", "zfs", "rw"),
+        Partition("tank", "/tank", "zfs", "rw"),
+        Partition("/dev/sda1", "/mnt/bind", "ext4", "rw"),
+        Partition("tmpfs", "/tmp", "tmpfs", "rw"),
+    ])
+    assert stat_client._enum_mounts() == {
+        "/dev/sda1": ("/boot", "ext4"),
+        "rpool": ("/", "zfs"),
+        "tank": ("/tank", "zfs"),
+    }
@@ -0,0 +1,97 @@
+"""http_report against a stand-in /report server"""
+import http.server
+import json
+import socket
+import threading
+import time
+import types
+
+import pytest
+
+pytest.importorskip("requests")
+
+import stat_client
+
+
+class StandIn:
+    """keep-alive /report server that can be restarted on the same port"""
+
+    def __init__(self):
+        self.reports = []
+        self.port = 0
+        self.start()
+
+    def start(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stand_in.reports.append(json.loads(body))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.conns = []
+
+        class Server(http.server.ThreadingHTTPServer):
+            def process_request(self, request, client_address):
+                stand_in.conns.append(request)
+                super().process_request(request, client_address)
+
+        self.srv = Server(("127.0.0.1", self.port), Handler)
+        self.port = self.srv.server_address[1]
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.srv.shutdown()
+        self.srv.server_close()
+        # a restarted server process does not keep the old keep-alive connections
+        for conn in self.conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait(self, n, timeout=3):
+        deadline = time.monotonic() + timeout
+        while len(self.reports) < n and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert len(self.reports) >= n
+
+
+STAT = {
+    "name": "h1", "cpu": 1.0, "custom": "",
+    "sys_info": {"name": "h1"},
+    "ip_info": {"query": "1.2.3.4"},
+    "disks": [{"name": "/dev/a", "total": 3}],
+}
+
+
+def test_static_fields_resent_after_server_restart(monkeypatch):
+    server = StandIn()
+    options = types.SimpleNamespace(addr="http://127.0.0.1:{}/report".format(server.port),
+                                    password="p1", interval=1, debug=False, compress="none")
+    monkeypatch.setattr(stat_client, "init_report", lambda options, stat_base: ("single", "h1"))
+    monkeypatch.setattr(stat_client, "register_collector", lambda *args, **kwargs: None)
+    monkeypatch.setattr(stat_client, "sample", lambda options, stat_base: dict(STAT))
+
+    def fixed_rate(interval):
+        for i in range(6):
+            yield i
+            server.wait(i + 1)
+            if i == 2:
+                server.stop()
+                server.start()
+
+    monkeypatch.setattr(stat_client, "fixed_rate", fixed_rate)
+    stat_client.http_report(options, {})
+    server.stop()
+
+    # 0-2 first server, 3-5 restarted one; 3 went out stripped on the new connection
+    assert ["disks" in r for r in server.reports] == [True, False, False, False, True, False]
@@ -0,0 +1,53 @@
+"""counter_delta and IfaceCounters"""
+import collections
+import types
+
+import stat_client
+from stat_client import U32, IfaceCounters, counter_delta
+
+NetIO = collections.namedtuple("NetIO", "bytes_recv bytes_sent")
+
+
+def test_counter_delta():
+    assert counter_delta(100, 250) == 150
+    # 32-bit counter wrapped
+    assert counter_delta(U32 - 10, 5) == 15
+    # iface re-created, counted from zero again
+    assert counter_delta(5000, 200) == 200
+    # 64-bit counters do not wrap, a drop is a reset
+    assert counter_delta(U32 * 4, 300) == 300
+
+
+class FakeHost:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        self.counters = {}
+        monkeypatch.setattr(stat_client.time, "monotonic", lambda: self.now)
+        monkeypatch.setattr(stat_client.psutil, "net_io_counters", lambda pernic: dict(self.counters))
+        self.options = types.SimpleNamespace(iface_filter=stat_client.IfaceFilter([], []))
+
+    def tick(self, ifaces, seconds=1):
+        self.now += seconds
+        self.counters = {name: NetIO(rx, tx) for name, (rx, tx) in ifaces.items()}
+        self.ifaces.update(self.options)
+        return self.ifaces.totals()
+
+
+def test_totals_across_wrap_reset_and_eviction(monkeypatch):
+    host = FakeHost(monkeypatch)
+    host.ifaces = IfaceCounters()
+    assert host.tick({"eth0": (1000, 100), "veth1": (500, 50)}) == (1500, 150)
+    assert host.tick({"eth0": (3000, 300), "veth1": (600, 60)}) == (3600, 360)
+    assert host.ifaces.rates() == (2100, 210)
+
+    # eth0 wraps its 32-bit rx counter, veth1 is re-created and starts over
+    assert host.tick({"eth0": (U32 - 1000, 400), "veth1": (10, 1)}) == (U32 - 1000 + 610, 461)
+    assert host.tick({"eth0": (1000, 500), "veth1": (20, 2)})[0] == U32 + 1000 + 620
+
+    before = host.ifaces.totals()
+    # veth1 gone for longer than STALE, its bytes stay in the totals
+    host.tick({"eth0": (1000, 500)}, seconds=IfaceCounters.STALE + 1)
+    assert "veth1" not in host.ifaces.ifaces
+    assert host.ifaces.totals() == before
+    assert [n["name"] for n in host.ifaces.nics()] == ["eth0"]
+    assert host.tick({"eth0": (2000, 600)}) == (before[0] + 1000, before[1] + 100)
@@ -0,0 +1,41 @@
+"""ProbeWindow"""
+import pytest
+
+from stat_client import ProbeWindow
+
+
+def test_empty_and_all_lost():
+    window = ProbeWindow(size=4)
+    assert window.stats() == {'lost_rate': 0.0, 'count': 0}
+    for _ in range(3):
+        window.push(False)
+    assert window.stats() == {'lost_rate': 1.0, 'count': 3}
+
+
+def test_percentiles_and_loss():
+    window = ProbeWindow(size=100)
+    for i in range(1, 91):
+        window.push(True, float(i))
+    for _ in range(10):
+        window.push(False)
+    o = window.stats()
+    assert o['count'] == 100 and o['lost_rate'] == 0.1
+    assert (o['min'], o['max'], o['avg']) == (1.0, 90.0, 45.5)
+    assert o['stddev'] == pytest.approx(25.98, abs=0.01)
+    assert (o['p50'], o['p95'], o['p99']) == (46.0, 86.0, 90.0)
+    assert o['jitter'] == 1.0
+
+
+def test_wraparound_forgets_the_oldest():
+    window = ProbeWindow(size=5)
+    # the first 5 are overwritten by the next 5
+    for rtt in (100.0, 100.0, None, None, 100.0, 10.0, None, 20.0, 30.0, 40.0):
+        window.push(rtt is not None, rtt or 0.0)
+    assert window.count == 5 and window.lost == 1
+    o = window.stats()
+    assert o['lost_rate'] == 0.2
+    assert (o['min'], o['max'], o['avg'], o['p50']) == (10.0, 40.0, 25.0, 30.0)
+    assert o['stddev'] == pytest.approx(11.18, abs=0.01)
+    # |10-100|, |20-10|, |30-20|, |40-30|
+    assert o['jitter'] == 30.0
+    assert window.lost_rate() == 0.2
@@ -0,0 +1,28 @@
+"""CollectorTimer"""
+import tracemalloc
+
+import stat_client
+
+
+def test_nested_calls_keep_the_outer_alloc_peak():
+    timer = stat_client.CollectorTimer(history=True)
+
+    def big():
+        b = bytearray(256 * 1024)
+        return len(b)
+
+    def small():
+        return len(bytearray(1024))
+
+    def outer():
+        timer.call("big", big)
+        timer.call("small", small)
+
+    tracemalloc.start()
+    try:
+        timer.call("total", outer)
+    finally:
+        tracemalloc.stop()
+    assert timer.last["big"][2] >= 256 * 1024
+    assert timer.last["small"][2] < 64 * 1024
+    assert timer.last["total"][2] >= timer.last["big"][2]
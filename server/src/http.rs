@@ -450,8 +450,32 @@ pub async fn report(_auth: auth::HostAuth, req_header: HeaderMap, body: Bytes) -
     }
 
     if let Some(mgr) = G_STATS_MGR.get() {
-        if mgr.report(json_data.unwrap()).is_err() {
-            return StatusCode::BAD_REQUEST;
+        // json array: reports of several hosts (group, tenants) and/or several
+        // reports of one host queued while the server was unreachable.
+        // stats keep no history, only the newest report of each host is applied
+        let items = match json_data.unwrap() {
+            Value::Array(items) => items,
+            v => vec![v],
+        };
+        let ts = |v: &Value| v.get("latest_ts").and_then(Value::as_u64).unwrap_or(0);
+        let mut newest: HashMap<String, usize> = HashMap::new();
+        for (i, v) in items.iter().enumerate() {
+            let name = v.get("name").and_then(Value::as_str).unwrap_or_default().to_string();
+            match newest.get(&name) {
+                Some(&j) if ts(&items[j]) > ts(v) => {}
+                _ => {
+                    newest.insert(name, i);
+                }
+            }
+        }
+        let mut keep = vec![false; items.len()];
+        for &i in newest.values() {
+            keep[i] = true;
+        }
+        for (v, keep) in items.into_iter().zip(keep) {
+            if keep && mgr.report(v).is_err() {
+                return StatusCode::BAD_REQUEST;
+            }
         }
     }
 
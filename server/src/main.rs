@@ -24,6 +24,7 @@ use axum::{
     Router,
 };
 use tower_http::cors::{Any, CorsLayer};
+use tower_http::decompression::RequestDecompressionLayer;
 
 mod assets;
 mod auth;
@@ -58,7 +59,8 @@ fn create_app_router() -> Router {
         .allow_origin(Any);
 
     Router::new()
-        .route("/report", post(http::report))
+        // clients may send gzip/zstd bodies (Content-Encoding)
+        .route("/report", post(http::report).layer(RequestDecompressionLayer::new()))
         .route("/json/stats.json", get(http::get_stats_json)) // 兼容就旧主题
         // .route("/config.pub.json", get(http::get_site_config_json)) // TODO
         .route("/api/admin/authorize", post(jwt::authorize))
@@ -197,6 +197,13 @@ impl StatsMgr {
                                 if stat_t.ip_info.is_none() {
                                     stat_t.ip_info = pre_stat.ip_info.to_owned();
                                 }
+                                // static fields are only sent on (re)connect or change
+                                if stat_t.sys_info.is_none() {
+                                    stat_t.sys_info = pre_stat.sys_info.to_owned();
+                                }
+                                if stat_t.disks.is_empty() {
+                                    stat_t.disks = pre_stat.disks.to_owned();
+                                }
 
                                 if stat_t.notify && (pre_stat.latest_ts + cfg.offline_threshold < stat_t.latest_ts) {
                                     // node up notify